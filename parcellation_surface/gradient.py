@@ -2,41 +2,182 @@ import os
 from typing import Literal
 import nibabel as nib
 import numpy as np
-import networkx as nx
 from datetime import datetime
 
+from .mesh_graph import MeshGraph, as_mesh_graph
 
-def build_mesh_graph(faces):
+
+def build_mesh_graph(faces, backend="csr"):
     """
     Build a graph from mesh faces for neighbor lookup.
     
     faces: ndarray of shape (n_faces, 3)
+    backend: "csr" (MeshGraph, vectorized) or "networkx" (networkx.Graph adapter)
     
-    Returns:nnew
-        graph: networkx.Graph object
+    Returns:
+        graph: MeshGraph object (or networkx.Graph)
     """
-    graph = nx.Graph()
-    for face in faces:
-        for i in range(3):
-            v1 = face[i]
-            v2 = face[(i + 1) % 3]
-            graph.add_edge(v1, v2)
+    graph = MeshGraph.from_faces(faces)
+    if backend == "networkx":
+        return graph.to_networkx()
     return graph
 
 
 # Most efficient method for large matrix gradient computation
 def compute_gradients(graph, 
-                      similarity_matrix):
+                      similarity_matrix,
+                      block_size=1024,
+                      reduce=None,
+                      n_jobs=1,
+                      smoothing_iterations=0):
     """
     Compute a local gradient magnitude at each vertex for each column of a 'similarity_matrix',
-    using an edge-based vectorized approach. This give all N vertices and M maps. Fast and efficient.
+    using a sparse edge incidence matrix. The maps are processed by column blocks in float32,
+    optionally spread over a thread pool (the sparse and dense products release the GIL).
+    With smoothing_iterations > 0 and reduce="sum" this is a fused smooth -> gradient -> sum stage:
+    each block of maps is smoothed on the mesh, its gradients are added to the summed map and the
+    block is discarded, so the peak memory is O(N * block_size * n_jobs) instead of 3 (N, M) arrays.
+    With a FactoredSimilarity no (N, M) array is ever allocated (the smoothing is applied to its left factor).
+    Matches compute_gradients_loop (float16 reference) within its half precision, rtol=1e-3,
+    and a float64 evaluation within rtol=1e-5.
     
     Args:
-        graph (networkx.Graph) : Undirected graph representing the mesh connectivity (one node per vertex).
+        graph (MeshGraph or networkx.Graph) : Undirected graph representing the mesh connectivity (one node per vertex).
             Nodes should be laeled 0..(N-1).
-        similarity_matrix (np.ndarray) (N vertices, M maps) : 'N' vertices and 'M' maps/columns. Column m is the scalar field for map m.
+        similarity_matrix (np.ndarray, np.memmap or FactoredSimilarity) (N vertices, M maps) : 'N' vertices and 'M' maps/columns. Column m is the scalar field for map m.
+        block_size (int) : number of maps processed at once.
+        reduce (None or "sum") : "sum" returns gradients.sum(axis=1) without allocating the (N, M) gradients.
+        n_jobs (int) : number of threads working on column blocks.
+        smoothing_iterations (int) : smooth each block with smooth_surface_graph before the gradient.
     Returns
         gradients (np.ndarray) : (N vertices, M maps) : gradients[v,m] = sqrt( sum_{u in neighbors(v)} (vals[v,m] - vals[u,m])^2 )
+            or (N vertices,) if reduce="sum".
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from .similarity_matrix import FactoredSimilarity
+    from .smoothing import build_smoothing_operator, smooth_surface_graph
+    if reduce not in (None, "sum"):
+        raise ValueError(f"reduce must be None or 'sum', got {reduce!r}.")
+    if not isinstance(similarity_matrix, FactoredSimilarity) and not hasattr(similarity_matrix, "shape"):
+        similarity_matrix = np.asarray(similarity_matrix)
+    N, M = similarity_matrix.shape
+    
+    # Signed incidence (E, N) -> edge differences, unsigned incidence (N, E) -> scatter to both endpoints
+    incidence = _incidence_matrix(_edge_array(graph), N)
+    incidence_abs = abs(incidence).T.tocsr()
+    if isinstance(similarity_matrix, FactoredSimilarity) and smoothing_iterations > 0:
+        # Smoothing acts on the left factor only (O(N*k)), once instead of on every block
+        similarity_matrix = smooth_surface_graph(graph, similarity_matrix, iterations=smoothing_iterations)
+        smoothing_iterations = 0
+    if smoothing_iterations > 0:
+        smoothing_operator = build_smoothing_operator(graph)
+    
+    def block_gradients(start, stop):
+        if isinstance(similarity_matrix, FactoredSimilarity):
+            block = similarity_matrix.col_block(start, stop)
+        else:
+            block = np.asarray(similarity_matrix[:, start:stop], dtype=np.float32)
+        for _ in range(smoothing_iterations):
+            block = smoothing_operator @ block
+        diff = incidence @ block # (E, b)
+        np.square(diff, out=diff)
+        return np.sqrt(incidence_abs @ diff) # (N, b)
+    
+    blocks = [(start, min(start + block_size, M)) for start in range(0, M, block_size)]
+    if reduce == "sum":
+        gradients = np.zeros(N, dtype=np.float64)
+        def run(bounds):
+            return block_gradients(*bounds).sum(axis=1, dtype=np.float64)
+    else:
+        gradients = np.empty((N, M), dtype=np.float32)
+        def run(bounds):
+            gradients[:, bounds[0]:bounds[1]] = block_gradients(*bounds)
+            return None
+    
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for partial_sum in pool.map(run, blocks):
+            if partial_sum is not None:
+                gradients += partial_sum
+    
+    if reduce == "sum":
+        return gradients.astype(np.float32)
+    return gradients
+
+
+def _incidence_matrix(edges, n_vertices):
+    """Signed (E, N) edge incidence matrix: row e is +1 at edges[e,0] and -1 at edges[e,1]"""
+    from scipy.sparse import csr_matrix
+    n_edges = edges.shape[0]
+    rows = np.repeat(np.arange(n_edges), 2)
+    data = np.tile(np.array([1, -1], dtype=np.float32), n_edges)
+    return csr_matrix((data, (rows, edges.ravel())), shape=(n_edges, n_vertices))
+
+
+def _edge_array(graph):
+    """Unique undirected edges of the mesh graph as an (E, 2) int array"""
+    return as_mesh_graph(graph).unique_edges
+
+
+def compute_summed_gradient_lowrank(graph,
+                                    factors,
+                                    smoothing_iterations=0):
+    """
+    Closed-form gradient map summed over all the similarity maps of a low-rank similarity S = L @ R.T.
+    Along an edge (v,u) the squared differences over all maps sum to a k x k quadratic form:
+        sum_m (S[v,m] - S[u,m])^2 = (L[v] - L[u]) @ (R.T @ R) @ (L[v] - L[u])
+    so the whole map costs O(E*k^2) and never builds the (N, M) similarity or gradient arrays.
+    
+    NOTE : this aggregates the maps in quadrature, i.e. it returns
+        sqrt( sum_m gradients[v,m]^2 )  with gradients = compute_gradients(graph, S),
+    the root-sum-square counterpart of compute_gradients(graph, S).sum(axis=1). The sum of the
+    per-map magnitudes (square roots) has no closed form in the factors.
+    
+    Args:
+        graph (MeshGraph or networkx.Graph) : Undirected graph representing the mesh connectivity, nodes 0..(N-1).
+        factors (FactoredSimilarity or np.ndarray) : the low-rank similarity, or its symmetric factor (N, k)
+            such that S = factors @ factors.T (e.g. the row-normalized fingerprints).
+        smoothing_iterations (int) : smooth the similarity maps on the mesh first (smooth_surface_graph).
+            Smoothing acts on the left factor only, so it commutes with the factorization.
+    Returns:
+        gradient_map (np.ndarray) : (N,) gradient map summed over the maps (in quadrature).
+    """
+    from .similarity_matrix import FactoredSimilarity
+    from .smoothing import smooth_surface_graph
+    if not isinstance(factors, FactoredSimilarity):
+        factors = FactoredSimilarity(factors)
+    if smoothing_iterations > 0:
+        factors = smooth_surface_graph(graph, factors, iterations=smoothing_iterations)
+    
+    left = factors.left.astype(np.float64)
+    right = factors.right.astype(np.float64)
+    n_vertices = left.shape[0]
+    # k x k Gram matrix of the right factor
+    gram = right.T @ right
+    
+    edges = _edge_array(graph)
+    diff = left[edges[:, 0]] - left[edges[:, 1]] # (E, k)
+    edge_energy = np.einsum('ek,kl,el->e', diff, gram, diff) # (E,)
+    edge_energy = np.maximum(edge_energy, 0) # rounding
+    
+    # Add the edge energy to both endpoints
+    squared_sums = np.bincount(edges[:, 0], weights=edge_energy, minlength=n_vertices) \
+                 + np.bincount(edges[:, 1], weights=edge_energy, minlength=n_vertices)
+    return np.sqrt(squared_sums).astype(np.float32)
+
+##%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% Other old methods for gradient computation %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+
+def compute_gradients_loop(graph, 
+                           similarity_matrix):
+    """
+    Reference edge loop for compute_gradients (float16, one Python iteration per edge).
+    Kept to validate the vectorized version on small meshes.
+    
+    Args:
+        graph (MeshGraph or networkx.Graph) : Undirected graph representing the mesh connectivity (one node per vertex).
+        similarity_matrix (np.ndarray) (N vertices, M maps)
+    Returns
+        gradients (np.ndarray) : (N vertices, M maps)
     """
     # Convert input to a NumPy array of shape (N, M)
     similarity_matrix = np.asarray(similarity_matrix, dtype=np.float16)
@@ -60,15 +201,13 @@ def compute_gradients(graph,
 
     return gradients
 
-##%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% Other old methods for gradient computation %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-
 
 def compute_gradient(graph, stat_map):
     """
     Compute the gradient magnitude at each vertex based on similarity map.
     
     stat_map: ndarray of shape (n_vertices,)
-    graph: networkx.Graph object
+    graph: MeshGraph or networkx.Graph object
     
     Returns:
         gradients: ndarray of shape (n_vertices,)
@@ -88,7 +227,7 @@ def compute_gradient_average(graph,
                             skip=10):
     """Compute the gradients of the similarty matrix on a mesh surface.
     Args:
-        graph (networkx.Graph): the mesh graph
+        graph (MeshGraph or networkx.Graph): the mesh graph
         similarity_matrix (np.array): the similarity matrix with maps stored in columns [n_vertices, n_maps]
         skip (int): the number of vertices to skip
     Returns:
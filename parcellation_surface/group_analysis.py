@@ -18,6 +18,9 @@ Usage:
 #%%
 import os
 import glob
+import threading
+import warnings
+from collections import OrderedDict
 from typing import Literal # Requires Python 3.8+
 import numpy as np
 import matplotlib.pyplot as plt
@@ -30,18 +33,38 @@ from .gradient import build_mesh_graph
 from .gradient import load_gradient_mgh
 from .watershed import load_labels_mgh
 
+def _as_seed_sequence(seed):
+    """SeedSequence of an int or SeedSequence seed. None draws the seed from the legacy global generator,
+    so that np.random.seed(...) still makes the nulls reproducible"""
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if seed is None:
+        seed = int(np.random.randint(np.iinfo(np.int64).max, dtype=np.int64))
+    return np.random.SeedSequence(seed)
+
+def _as_mesh_graph(graph):
+    """MeshGraph of a MeshGraph, networkx.Graph or dict[int, list[int]] adjacency"""
+    from .mesh_graph import MeshGraph, as_mesh_graph
+    if isinstance(graph, dict):
+        graph = MeshGraph.from_edges([(u, v) for u, nbrs in graph.items() for v in nbrs], len(graph))
+    return as_mesh_graph(graph)
+
 # Our Null Model
-from collections import deque
-def create_random_parcels(graph, n_clusters):
+def create_random_parcels(graph, n_clusters, rng=None):
     """
-    Randomly cluster a connected graph using BFS with 140 seeds.
+    Randomly cluster a connected graph by growing n_clusters random seeds with a multi-source BFS.
+    All the clusters grow together, one BFS frontier at a time, on the CSR neighbor arrays; a vertex
+    reached by several clusters in the same step goes to a random one of them. The vertices of the edges
+    joining two clusters are then marked as boundary.
     
     Args:
-        graph: dict[int, list[int]]
-            Adjacency list representation of the graph.
-            Keys are vertex IDs, values are lists of neighbors.
+        graph: MeshGraph, networkx.Graph or dict[int, list[int]]
+            Adjacency of the graph: graph[v] gives the neighbors of vertex v.
         n_clusters: int
             Number of clusters to grow.
+        rng: np.random.Generator or int, optional
+            Random generator (or seed). Defaults to None: seeded from the global np.random state,
+            so a preceding np.random.seed(...) makes the result reproducible.
     
     Returns:
         labels: np.ndarray
@@ -50,35 +73,131 @@ def create_random_parcels(graph, n_clusters):
             -2 = boundary
             >= 0 = cluster ID
     """
-    n_vertices = len(graph)
-    labels = np.full(n_vertices, -1, dtype=int)  # Initialize all vertices as unassigned
+    graph = _as_mesh_graph(graph)
+    if rng is None:
+        rng = _as_seed_sequence(None)
+    return _grow_random_parcels(graph.indptr, graph.indices, n_clusters, np.random.default_rng(rng))
+
+
+def _grow_random_parcels(indptr, indices, n_clusters, rng):
+    """Multi-source BFS of create_random_parcels on CSR arrays"""
+    n_vertices = len(indptr) - 1
+    degree = np.diff(indptr)
+    labels = np.full(n_vertices, -1, dtype=np.int32)  # Initialize all vertices as unassigned
     # Step 1: Randomly select seeds
-    seeds = np.random.choice(n_vertices, size=n_clusters, replace=False)
-    for cluster_id, seed in enumerate(seeds):
-        labels[seed] = cluster_id  # Assign each seed a unique cluster ID
-
-    # Step 2: Initialize queues for BFS
-    queues = [deque([seed]) for seed in seeds]
-
-    # Step 3: BFS Growth
-    while any(queues):  # While any cluster is still growing
-        for cluster_id, queue in enumerate(queues):
-            if not queue:
-                continue  # Skip if this cluster's queue is empty
-            current_vertex = queue.popleft()  # Get the next vertex to process
-            
-            # Iterate over neighbors of the current vertex
-            for neighbor in graph[current_vertex]:
-                if labels[neighbor] == -1:  # If the neighbor is unassigned
-                    labels[neighbor] = cluster_id  # Assign the current cluster ID
-                    queue.append(neighbor)  # Add the neighbor to the queue
-                elif labels[neighbor] >= 0 and labels[neighbor] != cluster_id:
-                    # Conflict: Neighbor belongs to a different cluster
-                    labels[current_vertex] = -2  # Mark the current vertex as a boundary
-                    labels[neighbor] = -2        # Mark the neighbor as a boundary
+    frontier = rng.choice(n_vertices, size=n_clusters, replace=False)
+    labels[frontier] = np.arange(n_clusters)  # Assign each seed a unique cluster ID
+    claim = np.empty(n_vertices, dtype=np.int64)
+    # Step 2: BFS growth, one frontier at a time for all clusters
+    while len(frontier):
+        # All (neighbor, cluster) candidates of the frontier
+        counts = degree[frontier]
+        starts = np.repeat(indptr[frontier] - np.cumsum(counts) + counts, counts)
+        neighbors = indices[starts + np.arange(counts.sum())]
+        clusters = np.repeat(labels[frontier], counts)
+        free = labels[neighbors] == -1
+        neighbors, clusters = neighbors[free], clusters[free]
+        # Random winner when several clusters reach the same vertex: candidates in random order,
+        # the candidate whose index is kept in `claim` wins
+        shuffle = rng.permutation(len(neighbors))
+        neighbors, clusters = neighbors[shuffle], clusters[shuffle]
+        candidates = np.arange(len(neighbors))
+        claim[neighbors] = candidates
+        winners = claim[neighbors] == candidates
+        frontier = neighbors[winners]
+        labels[frontier] = clusters[winners]
+    # Step 3: Vertices of the edges between two clusters are boundaries
+    rows = np.repeat(np.arange(n_vertices), degree)
+    conflict = (labels[rows] >= 0) & (labels[indices] >= 0) & (labels[rows] != labels[indices])
+    labels[rows[conflict]] = -2
+    return labels
+
 
+def _random_parcels_chunk(indptr, indices, n_clusters, seeds):
+    """Random parcellations of one worker, one independent stream per parcellation"""
+    return np.stack([_grow_random_parcels(indptr, indices, n_clusters, np.random.default_rng(seed))
+                     for seed in seeds])
+
+
+def generate_random_parcels(graph, 
+                            n_clusters,
+                            n_parcellations,
+                            seed=None,
+                            n_jobs=1,
+                            executor=None):
+    """
+    Batch of null parcellations (create_random_parcels), spread over a process pool.
+    Every parcellation has its own random stream spawned from `seed`, so the batch does not depend on n_jobs.
+    
+    Args:
+        graph: MeshGraph, networkx.Graph or dict[int, list[int]]
+        n_clusters (int): number of clusters of each parcellation.
+        n_parcellations (int): number of parcellations.
+        seed (int or np.random.SeedSequence, optional): root seed. Defaults to None (drawn from the global np.random state).
+        n_jobs (int, optional): number of worker processes. Defaults to 1 (no pool).
+        executor (concurrent.futures.Executor, optional): pool reused across calls (with n_jobs chunks),
+            instead of starting n_jobs new processes. Defaults to None.
+    Returns:
+        np.ndarray: (n_parcellations, n_vertices) int32 labels.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    graph = _as_mesh_graph(graph)
+    root = _as_seed_sequence(seed)
+    seeds = root.spawn(n_parcellations)
+    if n_jobs == 1 and executor is None:
+        return _random_parcels_chunk(graph.indptr, graph.indices, n_clusters, seeds)
+    chunks = [seeds[i::n_jobs] for i in range(n_jobs) if seeds[i::n_jobs]]
+    labels = np.empty((n_parcellations, graph.n_vertices), dtype=np.int32)
+    pool = ProcessPoolExecutor(max_workers=n_jobs) if executor is None else executor
+    try:
+        futures = [pool.submit(_random_parcels_chunk, graph.indptr, graph.indices, n_clusters, chunk) for chunk in chunks]
+        for i, future in enumerate(futures):
+            labels[i::n_jobs] = future.result()
+    finally:
+        if executor is None:
+            pool.shutdown()
     return labels
 
+def surface_boundary_map(labels, graph=None):
+    """
+    Boundary vertices of a surface parcellation.
+    
+    Args:
+        labels : (N,) or (S, N) ndarray
+            Parcel labels, negative values are boundaries (watershed -2 marks).
+            A stack of S parcellations gives S boundary maps.
+        graph : MeshGraph or networkx.Graph, optional
+            If given, the vertices of the edges joining two different parcels (>= 0) are boundaries too.
+    
+    Returns:
+        (N,) or (S, N) bool ndarray : boundary map(s).
+    """
+    from .mesh_graph import as_mesh_graph
+    labels = np.asarray(labels)
+    boundary = labels < 0
+    if graph is not None:
+        edges = as_mesh_graph(graph).unique_edges
+        label_u, label_v = labels[..., edges[:, 0]], labels[..., edges[:, 1]]
+        cut = (label_u != label_v) & (label_u >= 0) & (label_v >= 0)
+        maps, cut_edges = np.nonzero(cut.reshape(-1, len(edges)))
+        flat_boundary = boundary.reshape(-1, labels.shape[-1])
+        flat_boundary[maps, edges[cut_edges, 0]] = True
+        flat_boundary[maps, edges[cut_edges, 1]] = True
+    return boundary
+
+def surface_boundary_probability(labels_list, graph=None):
+    """
+    Fraction of the parcellations (e.g. subjects) in which each vertex is a boundary, in one pass.
+    
+    Args:
+        labels_list : (S, N) ndarray or list of (N,) arrays
+        graph : see surface_boundary_map
+    
+    Returns:
+        (N,) ndarray : boundary probability.
+    """
+    return surface_boundary_map(np.stack(labels_list), graph).mean(axis=0)
+
 def dice_coefficient(y_true, y_pred):
     """
     Compute the Dice coefficient between two binary masks.
@@ -101,10 +220,87 @@ def dice_coefficient(y_true, y_pred):
         return 1.0
     return 2 * intersection / union
 
+# Parcel indicators already built, keyed by (labels content, background), least recently used first.
+# Bounded so that streams of one-off labellings (e.g. nulls) do not accumulate.
+_PARCEL_INDICATORS = OrderedDict()
+_PARCEL_INDICATORS_MAXSIZE = 8
+_PARCEL_INDICATORS_LOCK = threading.Lock()
+
+def parcel_indicator(labels, background=-1, cache=True):
+    """
+    Sparse parcel-indicator matrix: P[k, v] = 1 if vertex v belongs to the k-th parcel.
+    The last _PARCEL_INDICATORS_MAXSIZE labellings are cached (the returned matrix is shared, do not modify it).
+    
+    Args:
+        labels (np.ndarray): (N,) parcel assignment of each vertex.
+        background (int, optional): labels <= background are not parcels (-1 unassigned, -2 boundary).
+        cache (bool, optional): keep the matrix for the next calls (False for one-off labellings, e.g. nulls).
+    Returns:
+        P (scipy.sparse.csr_matrix): (n_parcels, N) indicator.
+        parcels (np.ndarray): (n_parcels,) label of each row of P, in increasing order.
+    """
+    import hashlib
+    from scipy.sparse import csr_matrix
+    labels = np.asarray(labels).ravel()
+    key = (hashlib.sha1(labels.tobytes()).hexdigest(), str(labels.dtype), len(labels), background)
+    with _PARCEL_INDICATORS_LOCK:
+        if key in _PARCEL_INDICATORS:
+            _PARCEL_INDICATORS.move_to_end(key)
+            return _PARCEL_INDICATORS[key]
+    vertices = np.flatnonzero(labels > background)
+    parcels, rows = np.unique(labels[vertices], return_inverse=True)
+    P = csr_matrix((np.ones(len(vertices)), (rows, vertices)), shape=(len(parcels), len(labels)))
+    if cache:
+        with _PARCEL_INDICATORS_LOCK:
+            _PARCEL_INDICATORS[key] = (P, parcels)
+            while len(_PARCEL_INDICATORS) > _PARCEL_INDICATORS_MAXSIZE:
+                _PARCEL_INDICATORS.popitem(last=False)
+    return P, parcels
+
+def _centered_unit_rows(X, dtype=np.float64):
+    """Rows of X centered and scaled to unit norm (rows without variance are 0)"""
+    X = np.array(X, dtype=np.float64)
+    X -= X.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    np.divide(X, norms, out=X, where=norms > 0)
+    X[norms[:, 0] == 0] = 0
+    return X.astype(dtype, copy=False)
+
+def homogeneity_craddock(labels,
+                         list_surf_fmri_n,
+                         batch_size=4):
+    """Craddock homogeneity (mean of the pairwise Pearson correlations inside each parcel, diagonal included)
+    for all parcels and subjects at once.
+    With u_v the centered, unit-norm time series of vertex v, the mean correlation of a parcel p is
+    ||sum_{v in p} u_v||^2 / n_p^2, so all parcels of all subjects of a batch need one sparse product.
+    Vertices without variance count as correlation 0 (as np.nan_to_num(np.corrcoef(.))).
+    
+    Args:
+        labels (np.ndarray): (N,) parcel assignment of each vertex (labels < 0 are ignored).
+        list_surf_fmri_n (list or np.ndarray): S arrays (N, T) of fMRI time series (or a (S, N, T) stack).
+        batch_size (int, optional): number of subjects stacked in one product. Defaults to 4.
+    Returns:
+        homogeneity_parcels (np.ndarray): (S, n_parcels) homogeneity of each parcel of each subject.
+        homogeneity_sub (np.ndarray): (S,) mean across parcels, for each subject.
+        float: The mean homogeneity score across all subjects and parcels.
+    """
+    P, _ = parcel_indicator(labels)
+    sizes = np.asarray(P.sum(axis=1)).ravel()
+    n_subjects = len(list_surf_fmri_n)
+    homogeneity_parcels = np.zeros((n_subjects, P.shape[0]))
+    for start in range(0, n_subjects, batch_size):
+        # (N, S_batch, T) stack of centered unit-norm time series
+        X = np.stack([_centered_unit_rows(x) for x in list_surf_fmri_n[start:start + batch_size]], axis=1)
+        parcel_sums = (P @ X.reshape(X.shape[0], -1)).reshape(P.shape[0], X.shape[1], X.shape[2])
+        homogeneity_parcels[start:start + X.shape[1]] = (np.square(parcel_sums).sum(axis=2) / sizes[:, None]**2).T
+    homogeneity_sub = homogeneity_parcels.mean(axis=1)
+    return homogeneity_parcels, homogeneity_sub, np.mean(homogeneity_sub)
+
 def homogeneity_craddock_rt(labels, 
                             list_surf_fmri_n):
     """They take every pair of voxels within an ROI and compute the Pearson correlation between the two voxels fMRI time series.
     The homogeneity for that ROI is then the average of these pairwise correlations
+    (computed for all parcels at once by homogeneity_craddock).
     
     Args:
         labels (np.ndarray): An array where each element indicates the parcel assignment 
@@ -114,24 +310,186 @@ def homogeneity_craddock_rt(labels,
     Returns:
         float: The mean homogeneity score across all subjects and parcels.
     """
-    homogeneity_sub = []
-    for surf_fmri_n in list_surf_fmri_n: # average across all subjects
-        # Get unique parcel indices greater than 0 (non-zero parcels)
-        unique_parcels = np.unique(labels)
-        unique_parcels = unique_parcels[unique_parcels >= 0]  # Avoid zero or background parcel
-        # Initialize a list to store homogeneity scores for each parcel
-        homogeneity_parc = []
-        for parcel in unique_parcels: # average across all parcels
-            # make a correaltion of the vertex in the parcel
-            parcel_indices = np.where(labels == parcel)[0]
-            homogeneity_parc.append(np.nan_to_num(np.corrcoef(surf_fmri_n[parcel_indices, :])).mean()) # Craddock homogenity
-        homogeneity_sub.append(np.mean(homogeneity_parc))
-    return np.mean(homogeneity_sub) # Return the mean homogenity across all subjects
+    return homogeneity_craddock(labels, list_surf_fmri_n)[2] # Return the mean homogenity across all subjects
+
+
+class HomogeneityEvaluator:
+    """
+    Craddock homogeneity (see homogeneity_craddock) of many candidate or null parcellations.
+    The per-vertex statistics (centered unit-norm time series of every subject, side by side)
+    are computed once, each labelling then costs one sparse product.
+    
+    Args:
+        list_surf_fmri (list): S arrays (N, T) of fMRI time series.
+        dtype (np.dtype, optional): storage of the statistics. Defaults to np.float32.
+        background (int, optional): labels <= background are not parcels. Defaults to -1.
+    """
+    def __init__(self, list_surf_fmri, dtype=np.float32, background=-1):
+        self.n_subjects = len(list_surf_fmri)
+        self.n_vertices, self.n_timepoints = np.shape(list_surf_fmri[0])
+        self.background = background
+        self.unit_rows = np.empty((self.n_vertices, self.n_subjects * self.n_timepoints), dtype=dtype)
+        for s, surf_fmri in enumerate(list_surf_fmri):
+            self.unit_rows[:, s * self.n_timepoints:(s + 1) * self.n_timepoints] = _centered_unit_rows(surf_fmri, dtype)
+
+    def score_parcels(self, labels):
+        """(S, n_parcels) homogeneity of each parcel of each subject"""
+        P, _ = parcel_indicator(labels, self.background, cache=False)
+        sizes = np.asarray(P.sum(axis=1)).ravel()
+        parcel_sums = (P @ self.unit_rows).reshape(P.shape[0], self.n_subjects, self.n_timepoints)
+        return (np.square(parcel_sums, dtype=np.float64).sum(axis=2) / sizes[:, None]**2).T
+
+    def score(self, labels):
+        """Mean homogeneity across parcels and subjects"""
+        return self.score_parcels(labels).mean(axis=1).mean()
+
+    def score_many(self, labels_iterable, n_jobs=1):
+        """
+        Scores of a stream of labellings, in order, computed on n_jobs threads.
+        At most 2 * n_jobs labellings are held at once, so the memory does not grow with the stream.
+        
+        Yields:
+            float: score of each labelling.
+        """
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            pending = deque()
+            for labels in labels_iterable:
+                pending.append(pool.submit(self.score, labels))
+                if len(pending) >= 2 * n_jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def iter_random_parcels(graph,
+                        n_clusters,
+                        n_parcellations,
+                        seed=None,
+                        batch_size=100,
+                        n_jobs=1):
+    """Stream of null parcellations (create_random_parcels), generated by batches of generate_random_parcels.
+    With n_jobs > 1 the process pool is started once and reused by all the batches.
+    
+    Yields:
+        np.ndarray: (n_vertices,) labels.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    graph = _as_mesh_graph(graph)
+    root = _as_seed_sequence(seed)
+    n_batches = -(-n_parcellations // batch_size)
+    pool = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+    try:
+        for b, batch_seed in enumerate(root.spawn(n_batches)):
+            size = min(batch_size, n_parcellations - b * batch_size)
+            yield from generate_random_parcels(graph, n_clusters, size, seed=batch_seed,
+                                               n_jobs=n_jobs, executor=pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def null_test(evaluator,
+              observed_labels,
+              null_labels,
+              n_jobs=1):
+    """
+    Compare a parcellation with a null distribution of parcellations (higher score = better).
+    
+    Args:
+        evaluator (HomogeneityEvaluator): metric with its precomputed statistics.
+        observed_labels (np.ndarray): (N,) labels of the tested parcellation.
+        null_labels (iterable): null labellings, e.g. iter_random_parcels(...) (consumed as a stream).
+        n_jobs (int, optional): number of threads. Defaults to 1.
+    Returns:
+        dict: "observed" score, "null" scores (n_nulls,), "z" score and one-sided "p" value
+              (1 + #{null >= observed}) / (1 + n_nulls).
+    """
+    observed = evaluator.score(observed_labels)
+    null = np.fromiter(evaluator.score_many(null_labels, n_jobs), dtype=np.float64)
+    z = (observed - null.mean()) / null.std(ddof=1) if len(null) > 1 else np.nan
+    p = (1 + np.count_nonzero(null >= observed)) / (1 + len(null))
+    return {"observed": observed, "null": null, "z": z, "p": p}
+
+
+def homogeneity_timecourse_parcels(labels,
+                                   surf_fmri,
+                                   background=-1,
+                                   method="gram",
+                                   n_iter=100,
+                                   tol=1e-10):
+    """Percent of variance of each parcel explained by its first principal component (vertices as samples),
+    the explained_variance_ratio_[0] of a PCA fitted on each parcel, for all the parcels in one pass.
+    
+    Args:
+        labels (np.ndarray): (N,) parcel assignment of each vertex.
+        surf_fmri (np.ndarray): (N, T) fMRI time series.
+        background (int, optional): labels <= background are not parcels. Defaults to -1.
+        method (str, optional): "gram", exact leading eigenvalue of the smaller Gram matrix of each parcel,
+            or "power", power iterations on all the parcels at once. Defaults to "gram".
+        n_iter (int, optional): maximum number of power iterations. Defaults to 100.
+        tol (float, optional): relative change of the eigenvalues between two power iterations under which
+            they stop. A RuntimeWarning is raised if n_iter is reached first. Defaults to 1e-10.
+    Returns:
+        np.ndarray: (n_parcels,) homogeneity of each parcel (nan for single-vertex parcels), parcels in increasing label order.
+    """
+    from scipy.linalg import eigh
+    P, _ = parcel_indicator(labels, background)
+    X = np.asarray(surf_fmri, dtype=np.float64)
+    sizes = np.asarray(P.sum(axis=1)).ravel()
+    # Center each parcel across its vertices
+    parcel_of = np.full(X.shape[0], -1)
+    parcel_of[P.indices] = np.repeat(np.arange(P.shape[0]), np.diff(P.indptr))
+    inside = np.flatnonzero(parcel_of >= 0)
+    Xc = X[inside] - ((P @ X) / sizes[:, None])[parcel_of[inside]]
+    total_variance = np.bincount(parcel_of[inside], weights=np.square(Xc).sum(axis=1), minlength=P.shape[0])
+    
+    if method == "gram":
+        # Vertices sorted by parcel: each parcel is a contiguous block of rows
+        order = np.argsort(parcel_of[inside], kind="stable")
+        Xc = Xc[order]
+        bounds = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+        leading = np.zeros(P.shape[0])
+        for k in range(P.shape[0]):
+            block = Xc[bounds[k]:bounds[k + 1]]
+            G = block @ block.T if block.shape[0] <= block.shape[1] else block.T @ block
+            leading[k] = eigh(G, eigvals_only=True, subset_by_index=[G.shape[0] - 1, G.shape[0] - 1])[0]
+    elif method == "power":
+        # One vector per parcel, C_p v_p = sum_{v in p} (xc_v . v_p) xc_v for all parcels with sparse sums
+        parcel_rows = parcel_of[inside]
+        Pc = P[:, inside]
+        # Start from the centered time series of largest norm of each parcel (the centered parcel sum is ~0)
+        row_norms = np.einsum("ij,ij->i", Xc, Xc)
+        order = np.lexsort((row_norms, parcel_rows))
+        largest = order[np.flatnonzero(np.r_[parcel_rows[order][1:] != parcel_rows[order][:-1], True])]
+        v = np.zeros((P.shape[0], Xc.shape[1]))
+        v[parcel_rows[largest]] = Xc[largest]
+        norms = np.linalg.norm(v, axis=1, keepdims=True)
+        np.divide(v, norms, out=v, where=norms > 0)
+        leading = np.zeros(P.shape[0])
+        for _ in range(n_iter):
+            projections = np.einsum("ij,ij->i", Xc, v[parcel_rows])
+            w = Pc @ (projections[:, None] * Xc)
+            previous, leading = leading, np.einsum("ij,ij->i", w, v)
+            norms = np.linalg.norm(w, axis=1, keepdims=True)
+            v = np.divide(w, norms, out=v, where=norms > 0)
+            if np.all(np.abs(leading - previous) <= tol * np.abs(leading)):
+                break
+        else:
+            n_slow = np.count_nonzero(np.abs(leading - previous) > tol * np.abs(leading))
+            warnings.warn(f"Power iterations did not converge in {n_iter} iterations for {n_slow} parcels "
+                          f"(tol={tol}), use more iterations or method='gram'.", RuntimeWarning, stacklevel=2)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return leading / total_variance
 
 
 def homogeneity_timecourse(group_parcel,
-                        surf_fmri):
-    from sklearn.decomposition import PCA
+                        surf_fmri,
+                        background=-1,
+                        method="gram"):
     """The homogeneity of a parcel represents the percent of variance in the parcel explained by 
        the most common connectivity pattern.
     
@@ -140,34 +498,91 @@ def homogeneity_timecourse(group_parcel,
                                    of the corresponding vertex in the surface fMRI data.
         surf_fmri (np.ndarray): A 2D NORMALIZED array where each row represents a vertex and each column 
                                 represents a time point of the fMRI data.
+        background (int, optional): labels <= background are not parcels. Defaults to -1, so parcel 0
+                                    is kept as in the other metrics (background=0 drops it).
+        method (str, optional): "gram" or "power", see homogeneity_timecourse_parcels.
     Returns:
-        list: A list of homogeneity scores for each parcel.
+        float: The mean homogeneity score across the parcels.
     """
-    # Get unique parcel indices greater than 0 (non-zero parcels)
-    unique_parcels = np.unique(group_parcel)
-    unique_parcels = unique_parcels[unique_parcels > 0]  # Avoid zero or background parcel
-    # Initialize a list to store homogeneity scores for each parcel
-    homogeneity_scores = []
-    for parcel in unique_parcels:
-        # Extract the indices of vertices belonging to this parcel
-        parcel_indices = np.where(group_parcel == parcel)[0]
-        # Get the fMRI data for the vertices in the current parcel
-        parcel_data = surf_fmri[parcel_indices, :]
-        # Perform PCA on the parcel data
-        pca = PCA(n_components=1)
-        pca.fit(parcel_data)
-        # The homogeneity is the variance explained by the first principal component
-        explained_variance = pca.explained_variance_ratio_[0]
-        # Store the homogeneity score for this parcel
-        homogeneity_scores.append(explained_variance)
-    
-    # transform the homogeneity scores to a numpy array
-    homogeneity_scores = np.array(homogeneity_scores)
+    homogeneity_scores = homogeneity_timecourse_parcels(group_parcel, surf_fmri, background, method)
     # keep the mean homogeneity score
     homogeneity_mean = np.mean(homogeneity_scores)
     return homogeneity_mean
 
 
+def homogeneity_timecourse_batch(list_parcellations,
+                                 list_surf_fmri,
+                                 background=-1,
+                                 method="gram",
+                                 n_jobs=1):
+    """homogeneity_timecourse for every (parcellation, subject) pair, spread over threads.
+    
+    Args:
+        list_parcellations (list): P label arrays (N,).
+        list_surf_fmri (list): S fMRI arrays (N, T).
+        background, method: see homogeneity_timecourse.
+        n_jobs (int, optional): number of threads. Defaults to 1.
+    Returns:
+        np.ndarray: (P, S) mean homogeneity of each parcellation for each subject.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    pairs = [(labels, surf_fmri) for labels in list_parcellations for surf_fmri in list_surf_fmri]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        scores = list(pool.map(lambda pair: homogeneity_timecourse(*pair, background, method), pairs))
+    return np.array(scores).reshape(len(list_parcellations), len(list_surf_fmri))
+
+
+def parcel_timeseries(labels,
+                      list_surf_fmri,
+                      background=-1):
+    """
+    Mean fMRI time series of every parcel, for a stack of subjects (one sparse product per subject).
+    
+    Args:
+        labels (np.ndarray): (N,) parcel assignment of each vertex.
+        list_surf_fmri (list or np.ndarray): S arrays (N, T) (or a (S, N, T) stack).
+        background (int, optional): labels <= background are not parcels. Defaults to -1.
+    Returns:
+        np.ndarray: (S, n_parcels, T) parcel time series, parcels in increasing label order.
+    """
+    P, _ = parcel_indicator(labels, background)
+    sizes = np.asarray(P.sum(axis=1))
+    parcel_data = np.stack([np.asarray(P @ np.asarray(surf_fmri, dtype=np.float64)) for surf_fmri in list_surf_fmri])
+    return parcel_data / sizes[None]
+
+
+def parcel_connectomes(labels,
+                       list_surf_fmri,
+                       background=-1,
+                       fisher_z=False,
+                       average=False):
+    """
+    Parcel x parcel correlation matrices of a stack of subjects.
+    
+    Args:
+        labels (np.ndarray): (N,) parcel assignment of each vertex.
+        list_surf_fmri (list or np.ndarray): S arrays (N, T) (or a (S, N, T) stack).
+        background (int, optional): labels <= background are not parcels. Defaults to -1.
+        fisher_z (bool, optional): return arctanh(r) (diagonal set to 0). Defaults to False.
+        average (bool, optional): return the mean across subjects (in z space if fisher_z). Defaults to False.
+    Returns:
+        np.ndarray: (S, n_parcels, n_parcels) connectomes, or (n_parcels, n_parcels) if average.
+    """
+    parcel_data = parcel_timeseries(labels, list_surf_fmri, background)
+    # Batched np.corrcoef: centered, unit-norm rows
+    parcel_data -= parcel_data.mean(axis=2, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        parcel_data /= np.linalg.norm(parcel_data, axis=2, keepdims=True)
+    connectomes = np.clip(parcel_data @ parcel_data.transpose(0, 2, 1), -1, 1)
+    if fisher_z:
+        diagonal = np.arange(connectomes.shape[1])
+        connectomes[:, diagonal, diagonal] = 0
+        connectomes = np.arctanh(connectomes)
+    if average:
+        connectomes = connectomes.mean(axis=0)
+    return connectomes
+
+
 def parcel_correlation(group_parcel, 
                        surf_fmri):
     """
@@ -179,23 +594,12 @@ def parcel_correlation(group_parcel,
     Returns:
         np.ndarray: A 2D array representing the correlation matrix between the parcels.
     """
-    # Get unique parcel indices greater than 0 (non-zero parcels)
-    parcel_idx = np.unique(group_parcel[group_parcel >= 0])
-    n_parcels = len(parcel_idx)
-    
-    # Initialize an array to store mean fMRI data for each parcel
-    parcel_data = np.zeros((n_parcels, surf_fmri.shape[1]))
-    
-    # For each parcel, calculate the mean fMRI time series across vertices in the parcel
-    for i, idx in enumerate(parcel_idx):
-        # Boolean mask for vertices in the current parcel
-        mask = group_parcel == idx
-        # Compute the mean fMRI data for this parcel and store it
-        parcel_data[i] = np.mean(surf_fmri[mask], axis=0)
-        
-        # Check for NaN values in the computed parcel data
-        if np.isnan(parcel_data[i]).any():
-            print(f'Parcel {idx} has NaN values')
+    # Mean fMRI time series of each parcel (labels >= 0)
+    parcel_data = parcel_timeseries(group_parcel, [surf_fmri])[0]
+    # Check for NaN values in the computed parcel data
+    _, parcel_idx = parcel_indicator(group_parcel)
+    for idx in parcel_idx[np.isnan(parcel_data).any(axis=1)]:
+        print(f'Parcel {idx} has NaN values')
     
     # Compute and return the correlation matrix between parcels
     parcel_corr = np.corrcoef(parcel_data)
@@ -6,14 +6,16 @@ from pathlib import Path
 import numpy as np
 import nibabel as nib
 
-from preprocessing_surface import load_volume_data, fmri_vol2surf
-from similarity_matrix import compute_similarity_matrix
-from smoothing import smooth_surface, smooth_surface_graph
-from gradient import compute_gradients, compute_gradient_average, build_mesh_graph, \
+from nilearn.image import resample_img
+from preprocessing_surface import fmri_vol2surf, iter_masked_timeseries
+from similarity_matrix import compute_similarity_matrix_pca, compute_temporal_modes_streaming
+from smoothing import smooth_surface
+from gradient import compute_gradients, compute_gradient_average, \
                      save_gradient_mgh, load_gradient_mgh
 from watershed import watershed_by_flooding, save_labels_mgh \
                     , load_labels_mgh
 from visualization import visualize_brain_surface
+from mesh_cache import load_mesh_assets
 
 
 
@@ -29,7 +31,11 @@ def full_pipeline():
     # Global configuration defined once
     config = {
         "fsavg6_dir": Path(r"D:\Data_Conn_Preproc\PPSFACE_N18\fsaverage6"),
-        "subjects_dir": Path(r"D:\Data_Conn_Preproc\PPSFACE_N20")
+        "subjects_dir": Path(r"D:\Data_Conn_Preproc\PPSFACE_N20"),
+        "n_jobs": 4, # threads for the smoothing/gradient stage
+        # Stream the volume by slabs for the PCA (never holds the masked volume, but each slab of a
+        # .nii.gz decompresses the file again): only for volumes that do not fit in memory
+        "stream_volume": False,
     }
     
     for subject_num in range(1, 21):
@@ -47,8 +53,9 @@ def full_pipeline():
             vol_fmri_file = subj_dir / "func" / f"conn_wsraPPSFACE_sub-{subject}_run2.nii.gz"
             brain_mask_path = subj_dir / f"sub{subject}_freesurfer" / "mri" / "brainmask.mgz"
             
-            # LOAD SURFACE GEOMETRY
-            coords, faces = nib.freesurfer.read_geometry(str(surface_path))
+            # LOAD SURFACE GEOMETRY (graph and smoothing operators are cached on disk, memory-mapped)
+            mesh = load_mesh_assets(surface_path)
+            coords, faces, graph = mesh["coords"], mesh["faces"], mesh["graph"]
             
             # LOAD SURFACE DATA
             surf_fmri_img = nib.load(str(surf_fmri_path))
@@ -58,37 +65,49 @@ def full_pipeline():
             print(f"Surf data shape (2D): {surf_fmri.shape}")
             
             # Smooth the surf_fmri
-            surf_fmri = smooth_surface(faces, surf_fmri, iterations=5)
+            surf_fmri = smooth_surface(faces, surf_fmri, iterations=5, operator=mesh["neighbor_operator"])
             
-            # LOAD VOLUME DATA
-            vol_fmri, resampled_mask, affine = load_volume_data(str(vol_fmri_file),
-                                                                str(brain_mask_path))
-            print(f"Volume data shape: {vol_fmri.shape}")
+            # LOAD VOLUME DATA (header only, the voxels are streamed by slabs)
+            vol_fmri_img = nib.load(str(vol_fmri_file))
+            resampled_mask = resample_img(nib.load(str(brain_mask_path)),
+                                          target_affine=vol_fmri_img.affine,
+                                          target_shape=vol_fmri_img.shape[:3],
+                                          interpolation='nearest',
+                                          force_resample=True).get_fdata().astype(bool)
+            print(f"Volume data shape: {vol_fmri_img.shape}")
             
-            # BUILD MESH GRAPH
-            graph = build_mesh_graph(faces)
             print(f"Number of vertices: {coords.shape[0]}")
             print(f"Number of faces: {faces.shape[0]}")
             
-            # COMPUTE SIMILARITY MATRIX
-            similarity_matrix = compute_similarity_matrix(surf_fmri, vol_fmri, resampled_mask, n_modes=380)
-            del surf_fmri, vol_fmri  # Save memory
+            # COMPUTE SIMILARITY MATRIX (factored, O(N*k) memory: the N x N matrix is never allocated)
+            if config["stream_volume"]:
+                temporal_modes, _ = compute_temporal_modes_streaming(vol_fmri_img, resampled_mask)
+                vol_fmri_n = None
+            else:
+                # The whole file in one slab: read (and decompressed) once
+                vol_fmri_n = next(iter_masked_timeseries(vol_fmri_img, resampled_mask,
+                                                         slab_size=vol_fmri_img.shape[2]))
+                temporal_modes = None
+            similarity_matrix = compute_similarity_matrix_pca(vol_fmri_n, surf_fmri,
+                                                              temporal_modes=temporal_modes,
+                                                              factored=True)
+            del surf_fmri, vol_fmri_img, vol_fmri_n  # Save memory
             
-            print('Smoothing similarity matrix...')
-            sim_matrix_smoothed = smooth_surface_graph(graph, similarity_matrix, iterations=10)
+            # Smooth the similarity maps and sum their gradients block by block (no N x N array)
+            print('Smoothing similarity matrix and computing gradients...')
+            gradients_sum = compute_gradients(graph, similarity_matrix,
+                                              smoothing_iterations=10,
+                                              reduce="sum",
+                                              n_jobs=config["n_jobs"])
             del similarity_matrix  # Save memory
             
-            print('Computing gradients...')
-            gradients = compute_gradients(graph, sim_matrix_smoothed)
-            gradients_sum = gradients.sum(axis=1)
-            
             # SAVE GRADIENT MAP
             print('Saving gradients...')
             output_grad_path = subj_dir / "outputs_surface" / f"gradient_maprun2_{hemisphere}.mgh"
             save_gradient_mgh(gradients_sum, str(output_grad_path), hemisphere=hemisphere, name="grad_conn_fsavg6")
             
             # Further smoothing of gradient if needed
-            gradient_smoothed = smooth_surface(faces, gradients_sum, iterations=10)
+            gradient_smoothed = smooth_surface(faces, gradients_sum, iterations=10, operator=mesh["neighbor_operator"])
             
             # COMPUTE THE EDGE MAP (e.g., watershed segmentation)
             labels = watershed_by_flooding(graph, gradient_smoothed)
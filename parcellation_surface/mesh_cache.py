@@ -0,0 +1,159 @@
+"""
+Module Name: mesh_cache.py
+Description:
+    Persistent cache of the structures derived from a surface mesh.
+    The cache entry is keyed by a content hash of the surface file (and of the cortex label),
+    and every array is stored as an uncompressed .npy file loaded with mmap_mode='r'.
+    Subject jobs and worker processes therefore attach to the same read-only pages instead of
+    re-reading the surface and rebuilding the graph and smoothing operators.
+
+    Stored assets:
+      - coords, faces
+      - graph CSR (indptr, indices), unique edges, degrees, node order
+      - face and vertex areas
+      - smoothing operators (with self-loop for smooth_surface_graph, without for smooth_surface)
+      - medial wall mask (if a cortex label is given)
+"""
+import os
+import hashlib
+import tempfile
+import numpy as np
+import nibabel as nib
+from scipy.sparse import csr_matrix
+
+from .mesh_graph import MeshGraph
+from .smoothing import build_smoothing_operator, register_smoothing_operator
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "parcellation_surface")
+# Bumped when the stored assets change, older entries are then rebuilt
+CACHE_VERSION = 2
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """sha1 of the content of a file"""
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_surface(surface_path):
+    """Read (coords, faces) from a FreeSurfer geometry or a GIFTI (.gii) surface"""
+    surface_path = str(surface_path)
+    if surface_path.endswith(".gii"):
+        gii = nib.load(surface_path)
+        coords = gii.darrays[0].data  # shape: (N_vertices, 3)
+        faces = gii.darrays[1].data   # shape: (N_faces, 3)
+    else:
+        coords, faces = nib.freesurfer.read_geometry(surface_path)
+    return coords, faces
+
+
+def mesh_areas(coords, faces):
+    """Triangle areas (n_faces,) and vertex areas (n_vertices,) as 1/3 of the incident triangle areas"""
+    coords = np.asarray(coords, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    cross = np.cross(coords[faces[:, 1]] - coords[faces[:, 0]],
+                     coords[faces[:, 2]] - coords[faces[:, 0]])
+    face_areas = 0.5 * np.linalg.norm(cross, axis=1)
+    vertex_areas = np.bincount(faces.ravel(), weights=np.repeat(face_areas / 3, 3),
+                               minlength=coords.shape[0])
+    return face_areas.astype(np.float32), vertex_areas.astype(np.float32)
+
+
+def _build_assets(surface_path, cortex_label_path=None):
+    """Compute all the mesh-derived arrays, returns a dict name -> np.ndarray"""
+    coords, faces = read_surface(surface_path)
+    n_vertices = coords.shape[0]
+    graph = MeshGraph.from_faces(faces, n_vertices)
+    face_areas, vertex_areas = mesh_areas(coords, faces)
+    assets = {
+        "coords": np.asarray(coords, dtype=np.float32),
+        "faces": np.asarray(faces, dtype=np.int64),
+        "indptr": graph.indptr,
+        "indices": graph.indices,
+        "unique_edges": graph.unique_edges,
+        "degree": graph.degree,
+        "node_order": graph.node_order,
+        "face_areas": face_areas,
+        "vertex_areas": vertex_areas,
+    }
+    # int32 indices so that scipy keeps the memory-mapped arrays without a copy
+    for name, self_loop in [("smoothing", True), ("neighbor_smoothing", False)]:
+        operator = build_smoothing_operator(graph, self_loop=self_loop)
+        assets[f"{name}_data"] = operator.data.astype(np.float32)
+        assets[f"{name}_indices"] = operator.indices.astype(np.int32)
+        assets[f"{name}_indptr"] = operator.indptr.astype(np.int32)
+    if cortex_label_path is not None:
+        cortex = nib.freesurfer.read_label(str(cortex_label_path))
+        medial_wall = np.ones(n_vertices, dtype=bool)
+        medial_wall[cortex] = False
+        assets["medial_wall"] = medial_wall
+    return assets
+
+
+def load_mesh_assets(surface_path,
+                     cortex_label_path=None,
+                     cache_dir=None):
+    """
+    Load the mesh-derived structures of a surface, computing and caching them on first use.
+
+    Args:
+        surface_path (str): FreeSurfer surface (e.g. fsaverage6/surf/lh.white) or .gii file.
+        cortex_label_path (str, optional): cortex label (e.g. fsaverage6/label/lh.cortex.label)
+            used for the medial wall mask. Defaults to None (no mask).
+        cache_dir (str, optional): cache root directory. Defaults to ~/.cache/parcellation_surface.
+    Returns:
+        dict: with keys
+            "coords", "faces", "face_areas", "vertex_areas" (memory-mapped np.ndarray),
+            "graph" (MeshGraph on memory-mapped arrays),
+            "smoothing_operator" (csr_matrix, smooth_surface_graph; registered for "graph"),
+            "neighbor_operator" (csr_matrix, smooth_surface(..., operator=)),
+            "medial_wall" (bool np.ndarray or None).
+    """
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else str(cache_dir)
+    key = f"v{CACHE_VERSION}_" + file_hash(surface_path)
+    if cortex_label_path is not None:
+        key += "_" + file_hash(cortex_label_path)[:12]
+    entry_dir = os.path.join(cache_dir, key)
+
+    if not os.path.isdir(entry_dir):
+        assets = _build_assets(surface_path, cortex_label_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write in a temporary dir and rename, so that concurrent jobs never see a partial entry
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+        for name, array in assets.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), array)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError: # another job created it first
+            for name in assets:
+                os.remove(os.path.join(tmp_dir, name + ".npy"))
+            os.rmdir(tmp_dir)
+
+    def load(name):
+        path = os.path.join(entry_dir, name + ".npy")
+        return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+    n_vertices = load("degree").shape[0]
+    graph = MeshGraph(load("indptr"), load("indices"),
+                      unique_edges=load("unique_edges"), degree=load("degree"),
+                      node_order=load("node_order"))
+    operators = {}
+    for name in ["smoothing", "neighbor_smoothing"]:
+        operators[name] = csr_matrix((load(f"{name}_data"), load(f"{name}_indices"), load(f"{name}_indptr")),
+                                     shape=(n_vertices, n_vertices), copy=False)
+    register_smoothing_operator(graph, operators["smoothing"], self_loop=True)
+    register_smoothing_operator(graph, operators["neighbor_smoothing"], self_loop=False)
+
+    return {
+        "coords": load("coords"),
+        "faces": load("faces"),
+        "face_areas": load("face_areas"),
+        "vertex_areas": load("vertex_areas"),
+        "graph": graph,
+        "smoothing_operator": operators["smoothing"],
+        "neighbor_operator": operators["neighbor_smoothing"],
+        "medial_wall": load("medial_wall"),
+    }
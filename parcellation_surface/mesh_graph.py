@@ -0,0 +1,165 @@
+"""
+Module Name: mesh_graph.py
+Description:
+    Numpy/CSR representation of the surface mesh connectivity.
+    MeshGraph replaces networkx.Graph in the surface modules: it is built vectorized from the
+    faces and exposes the neighbors as CSR arrays (indptr, indices), the unique edges and the
+    vertex degrees. Nodes and neighbors keep the insertion order of the networkx graph built
+    from the same faces, so that order-dependent algorithms (watershed, NMS) give the same results. It also keeps the small part of the networkx API used by the pipeline
+    (neighbors, edges, number_of_nodes, graph[v], ...) and converts to/from networkx.
+"""
+import numpy as np
+
+
+class MeshGraph:
+    """
+    Undirected mesh graph stored as CSR arrays. Nodes are the vertices 0..(n_vertices-1).
+
+    Args:
+        indptr (np.ndarray): (n_vertices + 1,) CSR row pointer.
+        indices (np.ndarray): (2 * n_edges,) neighbors of each vertex, in edge insertion order.
+        unique_edges, degree, node_order (np.ndarray, optional): precomputed arrays (e.g. memory-mapped from the mesh cache).
+    Attributes:
+        unique_edges (np.ndarray): (n_edges, 2) undirected edges with unique_edges[:, 0] < unique_edges[:, 1].
+        degree (np.ndarray): (n_vertices,) number of neighbors of each vertex.
+        node_order (np.ndarray): (n_vertices,) vertices in node insertion order (the iteration order of `nodes`).
+    """
+    def __init__(self, indptr, indices, unique_edges=None, degree=None, node_order=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.n_vertices = len(self.indptr) - 1
+        self.degree = np.diff(self.indptr) if degree is None else degree
+        self.node_order = np.arange(self.n_vertices) if node_order is None else node_order
+        if unique_edges is None:
+            # Each undirected edge once (u < v)
+            rows = np.repeat(np.arange(self.n_vertices), self.degree)
+            upper = rows < self.indices
+            unique_edges = np.stack([rows[upper], self.indices[upper]], axis=1)
+        self.unique_edges = unique_edges
+
+    @classmethod
+    def from_edges(cls, edges, n_vertices=None):
+        """
+        Build the graph from an (E, 2) array of (possibly duplicated) undirected edges.
+        As with networkx.Graph.add_edge, the nodes are ordered by first appearance in `edges`
+        (then the vertices without edge) and the neighbors of a vertex by first appearance of the edge.
+        """
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        if n_vertices is None:
+            n_vertices = int(edges.max()) + 1 if len(edges) else 0
+        first_seen = np.full(n_vertices, len(edges) * 2, dtype=np.int64)
+        np.minimum.at(first_seen, edges.ravel(), np.arange(edges.size))
+        node_order = np.argsort(first_seen, kind="stable")
+        
+        position = np.flatnonzero(edges[:, 0] != edges[:, 1]) # no self-loops
+        edges = edges[position]
+        # Both directions encoded as a scalar key row * n_vertices + col, with the position of the edge
+        key = np.concatenate([edges[:, 0] * n_vertices + edges[:, 1],
+                              edges[:, 1] * n_vertices + edges[:, 0]])
+        position = np.concatenate([position, position])
+        # Keep the first occurrence of every directed edge
+        order = np.lexsort((position, key))
+        key, position = key[order], position[order]
+        first = np.concatenate([key[:1] == key[:1], key[1:] != key[:-1]])
+        key, position = key[first], position[first]
+        rows, cols = key // n_vertices, key % n_vertices
+        # CSR order: by row, then by insertion position
+        order = np.lexsort((position, rows))
+        indptr = np.zeros(n_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_vertices), out=indptr[1:])
+        return cls(indptr, cols[order], node_order=node_order)
+
+    @classmethod
+    def from_faces(cls, faces, n_vertices=None):
+        """Build the graph from the mesh triangles (n_faces, 3), edges (0, 1), (1, 2), (2, 0) face by face"""
+        faces = np.asarray(faces, dtype=np.int64)
+        edges = faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)
+        if n_vertices is None:
+            n_vertices = int(faces.max()) + 1 if len(faces) else 0
+        return cls.from_edges(edges, n_vertices)
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """Build the graph from a networkx.Graph with nodes 0..(N-1), keeping its node and neighbor order"""
+        n_vertices = graph.number_of_nodes()
+        adjacency = [[int(u) for u in graph.adj[v] if u != v] for v in range(n_vertices)]
+        indptr = np.zeros(n_vertices + 1, dtype=np.int64)
+        np.cumsum([len(neighbors) for neighbors in adjacency], out=indptr[1:])
+        indices = np.fromiter((u for neighbors in adjacency for u in neighbors), dtype=np.int64, count=indptr[-1])
+        node_order = np.fromiter((int(v) for v in graph.nodes()), dtype=np.int64, count=n_vertices)
+        return cls(indptr, indices, node_order=node_order)
+
+    def to_networkx(self):
+        """
+        Convert to a networkx.Graph (networkx is only needed here) with the same node and neighbor order.
+        An edge is added once it is the next neighbor of both its endpoints, so each adjacency dict is
+        filled in CSR order.
+        """
+        from collections import deque
+        import networkx as nx
+        graph = nx.Graph()
+        graph.add_nodes_from(self.node_order.tolist())
+        indptr, indices = self.indptr.tolist(), self.indices.tolist()
+        head = indptr[:-1] # position of the next neighbor of each vertex
+        
+        def next_neighbor(u):
+            return indices[head[u]] if head[u] < indptr[u + 1] else -1
+        
+        ready = deque((u, v) for u in range(self.n_vertices)
+                      for v in [next_neighbor(u)] if u < v and next_neighbor(v) == u)
+        while ready:
+            u, v = ready.popleft()
+            graph.add_edge(u, v)
+            for w in (u, v):
+                head[w] += 1
+                x = next_neighbor(w)
+                if x >= 0 and next_neighbor(x) == w:
+                    ready.append((w, x))
+        # Neighbor orders that no edge sequence produces (not from from_edges): remaining edges as they come
+        if graph.number_of_edges() < len(self.unique_edges):
+            graph.add_edges_from(self.unique_edges.tolist())
+        return graph
+
+    def adjacency(self, dtype=np.float32):
+        """Sparse (n_vertices, n_vertices) adjacency matrix (CSR)"""
+        from scipy.sparse import csr_matrix
+        data = np.ones(len(self.indices), dtype=dtype)
+        adjacency = csr_matrix((data, self.indices, self.indptr), shape=(self.n_vertices, self.n_vertices), copy=True)
+        adjacency.sort_indices()
+        return adjacency
+
+    # networkx-like API
+    @property
+    def nodes(self):
+        return self.node_order.tolist()
+
+    def number_of_nodes(self):
+        return self.n_vertices
+
+    def number_of_edges(self):
+        return len(self.unique_edges)
+
+    def edges(self):
+        return self.unique_edges
+
+    def neighbors(self, vertex):
+        return self.indices[self.indptr[vertex]:self.indptr[vertex + 1]]
+
+    def __len__(self):
+        return self.n_vertices
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __getitem__(self, vertex):
+        return self.neighbors(vertex)
+
+    def __repr__(self):
+        return f"MeshGraph(n_vertices={self.n_vertices}, n_edges={len(self.unique_edges)})"
+
+
+def as_mesh_graph(graph):
+    """Return `graph` as a MeshGraph (networkx graphs are converted)"""
+    if isinstance(graph, MeshGraph):
+        return graph
+    return MeshGraph.from_networkx(graph)
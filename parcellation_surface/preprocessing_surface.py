@@ -64,6 +64,37 @@ def load_data_normalized(surf_fmri_path,
     return surf_fmri_n, vol_fmri_n # Warning : the vol outputs are not in 3D anymore
 
 
+def iter_masked_timeseries(vol_fmri_img,
+                           mask_data,
+                           slab_size=8):
+    """
+    Stream the normalized time series of the mask voxels, one slab of slices at a time.
+    The voxels are read straight from the NIfTI proxy (img.dataobj), so the full 4D volume
+    is never loaded. Same normalization as load_data_normalized.
+
+    Args:
+        vol_fmri_img (nib.Nifti1Image): the 4D fMRI image (or a path to it).
+        mask_data (np.ndarray bool): 3D brain mask, in the fMRI voxel grid.
+        slab_size (int): number of slices (last spatial axis) read at once.
+
+    Yields:
+        np.ndarray: normalized time series of the mask voxels of the slab, shape (n_voxels_slab, n_timepoints), float32.
+    """
+    if not isinstance(vol_fmri_img, nib.spatialimages.SpatialImage):
+        vol_fmri_img = nib.load(str(vol_fmri_img))
+    mask_data = np.asarray(mask_data).astype(bool)
+    n_slices = vol_fmri_img.shape[2]
+    for z0 in range(0, n_slices, slab_size):
+        z1 = min(z0 + slab_size, n_slices)
+        mask_slab = mask_data[:, :, z0:z1]
+        if not mask_slab.any():
+            continue
+        slab = np.asarray(vol_fmri_img.dataobj[:, :, z0:z1, :], dtype=np.float32)
+        vol_fmri = slab[mask_slab].astype(np.float64)
+        vol_fmri_n = (vol_fmri - np.mean(vol_fmri, axis=1, keepdims=True)) / np.std(vol_fmri, axis=1, keepdims=True)
+        yield np.nan_to_num(vol_fmri_n).astype(np.float32)
+
+
 # This is a custom function for my data organisation
 from typing import Literal
 def extract_fmri_timeseries(dataset = Literal["PPSFACE_N18", "PPSFACE_N20"],
@@ -8,27 +8,300 @@ from sklearn.decomposition import PCA
 
 from .gradient import build_mesh_graph
 
-def compute_similarity_matrix_pca(vol_fmri_n,
-                                  surf_fmri_n,
-                                  n_components=17):
-    """Compute the similarity matrix with a PCA dim reduction
+def _modes_from_gram(gram, n_components):
+    """Top eigenpairs of the (n_timepoints, n_timepoints) Gram matrix Xc @ Xc.T of the centered data
+    Returns the (unflipped) left singular vectors, the singular values and the total variance sum.
+    """
+    from scipy.linalg import eigh
+    n_timepoints = gram.shape[0]
+    eigvals, eigvecs = eigh(gram, subset_by_index=[n_timepoints - n_components, n_timepoints - 1])
+    eigvals, eigvecs = eigvals[::-1], eigvecs[:, ::-1] # descending order
+    singular_values = np.sqrt(np.maximum(eigvals, 0))
+    return eigvecs, singular_values, np.trace(gram)
+
+
+def _flip_signs(U, max_loadings):
+    """sklearn sign convention (svd_flip, u_based_decision=False): the largest absolute
+    loading (component entry) of each mode is positive"""
+    return U * np.where(max_loadings < 0, -1, 1)
+
+
+def compute_temporal_modes(vol_fmri_n,
+                           n_components=17,
+                           method="auto",
+                           random_state=0):
+    """Extract the PCA temporal modes of the volume data (PCA of vol_fmri_n.T)
+    Args:
+        vol_fmri_n (2D np.ndarray): Normalized volume fMRI data. shape (n_voxels, n_timepoints)
+        n_components (int, optional): Number of Most important component to keep. Defaults to 17.
+        method (str, optional): "auto" (sklearn PCA default solver, as before: randomized on large inputs),
+            "full" (sklearn PCA with the exact LAPACK SVD, the reference), "randomized" (sklearn randomized SVD)
+            or "gram" (exact eigendecomposition of the small n_timepoints x n_timepoints Gram matrix). Defaults to "auto".
+        random_state (int, optional): seed of the randomized solver. Defaults to 0.
+    Returns:
+        temporal_modes (np.ndarray): PCA scores, same as PCA.fit_transform. shape (n_timepoints, n_components), float32
+        explained_variance_ratio (np.ndarray): shape (n_components,)
+    """
+    if method in ("auto", "full", "randomized"):
+        pca = PCA(n_components=n_components, svd_solver=method, random_state=random_state)
+        temporal_modes = pca.fit_transform(vol_fmri_n.T).astype(np.float32) # shape must be : (n_timepoints, n_components)
+        return temporal_modes, pca.explained_variance_ratio_
+    if method != "gram":
+        raise ValueError(f"method must be 'auto', 'full', 'randomized' or 'gram', got {method!r}.")
+    
+    # Samples are the time points: center each voxel over time
+    X = np.asarray(vol_fmri_n, dtype=np.float64)
+    X = X - X.mean(axis=1, keepdims=True) # (n_voxels, n_timepoints)
+    U, singular_values, total_variance = _modes_from_gram(X.T @ X, n_components)
+    loadings = U.T @ X.T # (n_components, n_voxels), same sign as the PCA components
+    max_loadings = loadings[np.arange(n_components), np.argmax(np.abs(loadings), axis=1)]
+    U = _flip_signs(U, max_loadings)
+    temporal_modes = (U * singular_values).astype(np.float32)
+    return temporal_modes, singular_values**2 / total_variance
+
+
+def compute_temporal_modes_streaming(vol_fmri_img,
+                                     mask_data,
+                                     n_components=17,
+                                     slab_size=8):
+    """Exact PCA temporal modes computed from voxel chunks streamed from the NIfTI file.
+    Only the (n_timepoints, n_timepoints) Gram matrix is accumulated, so the masked volume is never
+    held in memory. A second streaming pass fixes the signs (sklearn convention).
+    Args:
+        vol_fmri_img (nib.Nifti1Image or str): the 4D fMRI image or its path.
+        mask_data (np.ndarray bool): 3D brain mask in the fMRI voxel grid.
+        n_components (int, optional): Number of Most important component to keep. Defaults to 17.
+        slab_size (int, optional): number of slices read at once. Defaults to 8.
+    Returns:
+        temporal_modes (np.ndarray): shape (n_timepoints, n_components), float32
+        explained_variance_ratio (np.ndarray): shape (n_components,)
+    """
+    from .preprocessing_surface import iter_masked_timeseries
+    if not isinstance(vol_fmri_img, nib.spatialimages.SpatialImage):
+        vol_fmri_img = nib.load(str(vol_fmri_img))
+    
+    gram = None
+    for chunk in iter_masked_timeseries(vol_fmri_img, mask_data, slab_size):
+        chunk = chunk.astype(np.float64)
+        chunk -= chunk.mean(axis=1, keepdims=True)
+        gram = chunk.T @ chunk if gram is None else gram + chunk.T @ chunk
+    U, singular_values, total_variance = _modes_from_gram(gram, n_components)
+    
+    # Second pass : the largest absolute loading of each component (first occurrence)
+    max_abs = np.full(n_components, -np.inf)
+    max_loadings = np.zeros(n_components)
+    for chunk in iter_masked_timeseries(vol_fmri_img, mask_data, slab_size):
+        chunk = chunk.astype(np.float64)
+        chunk -= chunk.mean(axis=1, keepdims=True)
+        loadings = U.T @ chunk.T # (n_components, n_voxels_chunk)
+        idx = np.argmax(np.abs(loadings), axis=1)
+        values = loadings[np.arange(n_components), idx]
+        update = np.abs(values) > max_abs
+        max_abs[update] = np.abs(values[update])
+        max_loadings[update] = values[update]
+    U = _flip_signs(U, max_loadings)
+    temporal_modes = (U * singular_values).astype(np.float32)
+    return temporal_modes, singular_values**2 / total_variance
+
+
+def compute_fingerprint_pca(vol_fmri_n,
+                            surf_fmri_n,
+                            n_components=17,
+                            pca_method="auto",
+                            temporal_modes=None):
+    """Compute the connectivity fingerprint of each vertex with the PCA temporal modes
     Args:
-        surf_fmri_n (2D np.ndarray): Normalized surface fMRI data. shape (n_vertices, n_timepoints)
         vol_fmri_n (2D np.ndarray): Normalized volume fMRI data. shape (n_voxels, n_timepoints)
+        surf_fmri_n (2D np.ndarray): Normalized surface fMRI data. shape (n_vertices, n_timepoints)
         n_components (int, optional): Number of Most important component to keep. Defaults to 17.
+        pca_method (str, optional): solver of compute_temporal_modes. Defaults to "auto".
+        temporal_modes (np.ndarray, optional): precomputed modes (n_timepoints, n_components),
+            e.g. from compute_temporal_modes_streaming. vol_fmri_n is then not used.
+    Returns:
+        np.ndarray: the fingerprint (correlation with each temporal mode). shape (n_vertices, n_components)
     """
     # 4. Run PCA on the time series data
-    pca = PCA(n_components=n_components)
-    temporal_modes = pca.fit_transform(vol_fmri_n.T).astype(np.float32) # shape must be : (n_timepoints, n_components)
-    # print the percent of explained variacne 
-    # print('explained variance:', pca.explained_variance_ratio_)
-    # print('explained variance sum:', pca.explained_variance_ratio_.sum())
+    if temporal_modes is None:
+        temporal_modes, explained_variance_ratio = compute_temporal_modes(vol_fmri_n,
+                                                                          n_components=n_components,
+                                                                          method=pca_method)
+        # print the percent of explained variacne 
+        # print('explained variance:', explained_variance_ratio)
+        # print('explained variance sum:', explained_variance_ratio.sum())
     
     # Correlation formula for normalized data
     corr_matrix = (surf_fmri_n @ temporal_modes)  / (surf_fmri_n.shape[1] - 1) # shape will be (n_vertices, n_components)
-    # Similarty matrix
-    sim_matrix = np.corrcoef(corr_matrix, dtype=np.float32) # shape = (n_vertices, n_vertices)
-    sim_matrix = np.nan_to_num(sim_matrix) # remove nans if any
+    return corr_matrix
+
+
+def _normalize_rows(corr_matrix):
+    """Center and scale each row to unit norm so that the row correlation is a dot product.
+    Rows without variance are set to 0 (same as np.nan_to_num on np.corrcoef).
+    """
+    factors = np.asarray(corr_matrix, dtype=np.float64)
+    factors = factors - factors.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(factors, axis=1, keepdims=True)
+    norms[norms == 0] = np.inf
+    return (factors / norms).astype(np.float32)
+
+
+def _similarity_block_size(n_vertices, block_size=None, memory_budget_gb=1.0):
+    """Number of rows/columns per tile so that one tile (and its temporaries) fits the budget"""
+    # A float32 tile (b, b) plus the clipping temporary
+    max_block = int(np.sqrt(memory_budget_gb * 1024**3 / (2 * 4)))
+    if block_size is None:
+        block_size = max_block
+    block_size = max(1, min(int(block_size), max_block, n_vertices))
+    return block_size
+
+
+def similarity_matrix_tiled(corr_matrix,
+                            output_path=None,
+                            block_size=None,
+                            memory_budget_gb=1.0):
+    """Compute the similarity matrix np.corrcoef(corr_matrix) tile by tile.
+    Only one (block_size, block_size) tile is held in RAM at a time, the tiles are
+    written straight into the output (a memory-mapped .npy file if output_path is given).
+    
+    Args:
+        corr_matrix (2D np.ndarray): the fingerprints. shape (n_vertices, n_components)
+        output_path (str, optional): .npy file backing the output. If None the output is held in RAM.
+        block_size (int, optional): rows/columns per tile. Defaults to the largest tile fitting the budget.
+        memory_budget_gb (float, optional): RAM budget for one tile in GB. Defaults to 1.
+    Returns:
+        np.ndarray or np.memmap: the similarity matrix (n_vertices, n_vertices), float32
+    """
+    factors = _normalize_rows(corr_matrix)
+    n_vertices = factors.shape[0]
+    block_size = _similarity_block_size(n_vertices, block_size, memory_budget_gb)
+    
+    if output_path is None:
+        sim_matrix = np.empty((n_vertices, n_vertices), dtype=np.float32)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        sim_matrix = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32,
+                                               shape=(n_vertices, n_vertices))
+    
+    tile = np.empty((block_size, block_size), dtype=np.float32)
+    for i0 in range(0, n_vertices, block_size):
+        i1 = min(i0 + block_size, n_vertices)
+        for j0 in range(0, n_vertices, block_size):
+            j1 = min(j0 + block_size, n_vertices)
+            block = tile[:i1 - i0, :j1 - j0]
+            np.matmul(factors[i0:i1], factors[j0:j1].T, out=block)
+            np.clip(block, -1, 1, out=block) # as np.corrcoef
+            sim_matrix[i0:i1, j0:j1] = block
+    
+    if isinstance(sim_matrix, np.memmap):
+        sim_matrix.flush()
+    return sim_matrix
+
+
+class FactoredSimilarity:
+    """Low-rank similarity matrix S = left @ right.T that never materializes the (N, M) array.
+    For the PCA similarity, left = right = the row-normalized fingerprints (N, k), so
+    S[i, j] = np.corrcoef(corr_matrix)[i, j]. Smoothing the maps on the mesh only changes
+    the left factor, which keeps the storage at O(N*k).
+    
+    Args:
+        left (2D np.ndarray): left factor. shape (n_vertices, rank)
+        right (2D np.ndarray, optional): right factor. shape (n_maps, rank). Defaults to left (symmetric).
+    """
+    def __init__(self, left, right=None):
+        self.left = np.asarray(left, dtype=np.float32)
+        self.right = self.left if right is None else np.asarray(right, dtype=np.float32)
+        if self.left.ndim != 2 or self.right.ndim != 2 or self.left.shape[1] != self.right.shape[1]:
+            raise ValueError(
+                f"Factors must be 2D with the same rank, got {self.left.shape} and {self.right.shape}."
+            )
+    
+    @classmethod
+    def from_fingerprint(cls, corr_matrix):
+        """Build the factored np.corrcoef(corr_matrix) from the fingerprints (n_vertices, n_components)"""
+        return cls(_normalize_rows(corr_matrix))
+    
+    @property
+    def shape(self):
+        return (self.left.shape[0], self.right.shape[0])
+    
+    @property
+    def rank(self):
+        return self.left.shape[1]
+    
+    ndim = 2
+    dtype = np.dtype(np.float32)
+    
+    @property
+    def T(self):
+        return FactoredSimilarity(self.right, self.left)
+    
+    def column(self, j):
+        """Similarity map j, shape (n_vertices,)"""
+        return self.left @ self.right[j]
+    
+    def col_block(self, start, stop):
+        """Similarity maps start..stop-1, shape (n_vertices, stop - start)"""
+        return self.left @ self.right[start:stop].T
+    
+    def row_block(self, start, stop):
+        """Rows start..stop-1 of the similarity matrix, shape (stop - start, n_maps)"""
+        return self.left[start:stop] @ self.right.T
+    
+    def dot(self, x):
+        """Matrix-vector (or matrix-matrix) product S @ x in O((N + M) * k) per vector"""
+        return self.left @ (self.right.T @ np.asarray(x, dtype=np.float32))
+    
+    __matmul__ = dot
+    
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        return self.left[rows] @ self.right[cols].T
+    
+    def toarray(self):
+        """Materialize the dense (N, M) matrix (only for small meshes)"""
+        return self.left @ self.right.T
+    
+    def __array__(self, dtype=None, copy=None):
+        dense = self.toarray()
+        return dense if dtype is None else dense.astype(dtype)
+
+
+def compute_similarity_matrix_pca(vol_fmri_n,
+                                  surf_fmri_n,
+                                  n_components=17,
+                                  output_path=None,
+                                  block_size=None,
+                                  memory_budget_gb=1.0,
+                                  factored=False,
+                                  pca_method="auto",
+                                  temporal_modes=None):
+    """Compute the similarity matrix with a PCA dim reduction
+    Args:
+        surf_fmri_n (2D np.ndarray): Normalized surface fMRI data. shape (n_vertices, n_timepoints)
+        vol_fmri_n (2D np.ndarray): Normalized volume fMRI data. shape (n_voxels, n_timepoints)
+        n_components (int, optional): Number of Most important component to keep. Defaults to 17.
+        output_path (str, optional): .npy file for a memory-mapped output (out-of-core). Defaults to None (RAM).
+        block_size (int, optional): rows/columns per tile. Defaults to the largest tile fitting the budget.
+        memory_budget_gb (float, optional): RAM budget for one tile in GB. Defaults to 1.
+        factored (bool, optional): return a FactoredSimilarity (O(N*k) memory) instead of the dense matrix.
+        pca_method (str, optional): "auto", "full", "randomized" or "gram", see compute_temporal_modes. Defaults to "auto".
+        temporal_modes (np.ndarray, optional): precomputed temporal modes (n_timepoints, n_components),
+            e.g. from compute_temporal_modes_streaming; vol_fmri_n can then be None.
+    Returns:
+        np.ndarray, np.memmap or FactoredSimilarity: the similarity matrix (n_vertices, n_vertices), float32
+    """
+    corr_matrix = compute_fingerprint_pca(vol_fmri_n,
+                                          surf_fmri_n,
+                                          n_components=n_components,
+                                          pca_method=pca_method,
+                                          temporal_modes=temporal_modes) # shape (n_vertices, n_components)
+    if factored:
+        return FactoredSimilarity.from_fingerprint(corr_matrix)
+    # Similarty matrix (np.corrcoef of the fingerprints, computed by tiles)
+    sim_matrix = similarity_matrix_tiled(corr_matrix,
+                                         output_path=output_path,
+                                         block_size=block_size,
+                                         memory_budget_gb=memory_budget_gb)
     return sim_matrix
 
 
@@ -53,21 +326,29 @@ def save_similartiy_matrix(similarity_matrix,
                            output_dir,
                            hemisphere: Literal["lh", "rh"]
                            ) -> None:
-    """Save the similarity matrix into a .npy file
+    """Save the similarity matrix into a .npy file (.npz with the factors for a FactoredSimilarity)
     Args:
-        gradient_map (2d np.array): the similartiy matrix (n_vertex, n_vertex) same order as coords
+        gradient_map (2d np.array or FactoredSimilarity): the similartiy matrix (n_vertex, n_vertex) same order as coords
         output_dir (string): dir for sim map output
         hemisphere (strinf): the hemisphere of the surface data
     """
     time = datetime.now().strftime("%Y%m%d%H%M%S")
+    if isinstance(similarity_matrix, FactoredSimilarity):
+        path = output_dir + f"\{hemisphere}similarity_matrix_{time}.npz"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, left=similarity_matrix.left, right=similarity_matrix.right)
+        return
     path = output_dir + f"\{hemisphere}similarity_matrix_{time}.npy"
     os.makedirs(os.path.dirname(path), exist_ok=True)
     np.save(path, similarity_matrix)
 
 def load_similarity_matrix(path):
     """
-    Load the similarity matrix
+    Load the similarity matrix (a FactoredSimilarity for .npz files)
     """
+    if str(path).endswith(".npz"):
+        with np.load(path) as factors:
+            return FactoredSimilarity(factors["left"], factors["right"])
     similarity_matrix = np.load(path)
     return similarity_matrix
 
@@ -77,7 +358,6 @@ if __name__ == "__main__":
     from pathlib import Path
     import numpy as np
     import nibabel as nib 
-    import networkx as nx
     from gradient import build_mesh_graph
     from preprocessing_surface import load_data_normalized
     
@@ -100,7 +380,7 @@ if __name__ == "__main__":
     graph = build_mesh_graph(faces)
     
     # 1 : Compute the average similartiy matrix across each subjects
-    sim_matrix_sum = np.zeros(nx.adjacency_matrix(graph).shape, dtype=np.float32)
+    sim_matrix_sum = np.zeros(graph.adjacency().shape, dtype=np.float32)
     print('sim_matrix_sum shape', sim_matrix_sum.shape)
 
     # Define paths using pathlib
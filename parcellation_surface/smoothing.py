@@ -1,90 +1,121 @@
+import weakref
 import numpy as np
 import nibabel as nib
-import networkx as nx
-from scipy.sparse import csr_matrix, coo_matrix
+from scipy.sparse import coo_matrix
 
 
-def smooth_surface(faces, values, iterations=5):
+def smooth_surface(faces, values, iterations=5, operator=None):
     """    
-    Smooth a surface-based fMRI statistical map using neighborhood averaging. WARNING : Memory expensive for large maps.
+    Smooth a surface-based fMRI statistical map using neighborhood averaging (mean of the neighbors, without the vertex itself).
     Args:
         faces : (M, 3) ndarray
             Triangles as vertex indices.
         values (np.array): 1D or 2D array of statistical values on the surface mesh. (n_vertices, n_maps)
         iterations (int, optional): smoothing intensity. Defaults to 5.
+        operator (scipy.sparse.csr_matrix, optional): precomputed operator, e.g. from the mesh asset cache
+            (build_smoothing_operator(graph, self_loop=False)). Built from the faces if None.
 
     Returns:
         np.array : 1D or 2D array of smoothed statistical values on the surface mesh. (n_vertices, n_maps)
     """
-    # Ensure inputs are numpy arrays
-    faces = np.asarray(faces)
+    from .mesh_graph import MeshGraph
     values = np.asarray(values, dtype=np.float32)
-    
     n_vertices = values.shape[0]
     
-    # Step 1: Extract unique edges from faces
-    edges = set()
-    for face in faces:
-        v1, v2, v3 = face
-        edges.add(tuple(sorted((v1, v2))))
-        edges.add(tuple(sorted((v2, v3))))
-        edges.add(tuple(sorted((v1, v3))))
-    
-    # Convert edges to row and column indices
-    row = []
-    col = []
-    for edge in edges:
-        row.extend([edge[0], edge[1]])  # Add both directions
-        col.extend([edge[1], edge[0]])
-    
-    data = np.ones(len(row), dtype=np.float32)
-    
-    # Step 2: Create sparse adjacency matrix
-    adjacency = coo_matrix((data, (row, col)), shape=(n_vertices, n_vertices)).tocsr()
-    
-    # Step 3: Compute degree of each vertex
-    degree = adjacency.sum(axis=1).A1  # Convert to 1D array
-    degree[degree == 0] = 1  # Prevent division by zero
-    
-    # Step 4: Create normalization matrix (W = D^-1)
-    W = csr_matrix((1.0 / degree, (np.arange(n_vertices), np.arange(n_vertices))), shape=(n_vertices, n_vertices))
+    if operator is None:
+        # Row-normalized adjacency W = D^-1 A, built vectorized from the faces
+        operator = build_smoothing_operator(MeshGraph.from_faces(faces, n_vertices), self_loop=False)
     
-    # Step 5: Define the smoothing operator (W * adjacency)
-    smoothing_operator = W.dot(adjacency)
-    
-    # Step 6: Initialize smoothed_map
     smoothed_map = values.copy()
-    
-    # Step 7: Perform iterative smoothing
     for _ in range(iterations):
-        smoothed_map = smoothing_operator.dot(smoothed_map)
+        smoothed_map = operator.dot(smoothed_map)
     
     return smoothed_map
 
 
-def smooth_surface_graph(graph, values, iterations=10):
+def build_smoothing_operator(graph, self_loop=True):
+    """
+    Row-normalized CSR smoothing operator of the mesh graph, including the self-loop:
+    (W @ x)[u] = (x[u] + sum_{v in neighbors(u)} x[v]) / (1 + degree(u)).
+    Without the self-loop (smooth_surface): (W @ x)[u] = mean_{v in neighbors(u)} x[v].
+    The operator is cached per graph object, so repeated calls are free.
+    
+    Args:
+        graph (MeshGraph or networkx.Graph): Undirected graph with nodes 0..n_vertices-1.
+        self_loop (bool): include the vertex itself in the average. Defaults to True.
+    Returns:
+        scipy.sparse.csr_matrix: (n_vertices, n_vertices) float32 smoothing operator.
+    """
+    operator = _SMOOTHING_OPERATORS.get(graph, {}).get(self_loop)
+    if operator is not None:
+        return operator
+    from .mesh_graph import as_mesh_graph
+    mesh_graph = as_mesh_graph(graph)
+    n_vertices = mesh_graph.n_vertices
+    edges = mesh_graph.unique_edges
+    # Both directions of every edge (+ the self-loops)
+    row = [edges[:, 0], edges[:, 1]]
+    col = [edges[:, 1], edges[:, 0]]
+    if self_loop:
+        row.append(np.arange(n_vertices))
+        col.append(np.arange(n_vertices))
+    row, col = np.concatenate(row), np.concatenate(col)
+    data = np.ones(len(row), dtype=np.float32)
+    adjacency = coo_matrix((data, (row, col)), shape=(n_vertices, n_vertices)).tocsr()
+    adjacency.sum_duplicates()
+    adjacency.data[:] = 1 # in case of duplicated edges
+    count = np.diff(adjacency.indptr)
+    # Row normalization (D^-1 (I + A)), empty rows stay empty
+    adjacency.data /= np.repeat(count, count).astype(np.float32)
+    register_smoothing_operator(graph, adjacency, self_loop=self_loop)
+    return adjacency
+
+
+def register_smoothing_operator(graph, operator, self_loop=True):
+    """Store a precomputed smoothing operator (e.g. memory-mapped from the mesh cache) for `graph`"""
+    _SMOOTHING_OPERATORS.setdefault(graph, {})[self_loop] = operator
+
+_SMOOTHING_OPERATORS = weakref.WeakKeyDictionary()
+
+
+def smooth_surface_graph(graph, values, iterations=10, out=None, block_size=1024, n_jobs=1):
     """
     Smooth a surface-based fMRI statistical map using neighborhood averaging iteratively.
-    This version is more memory-efficient because it 
-    avoids building a full n x n adjacency matrix.
+    Each iteration replaces a vertex by the mean of itself and its neighbors, applied with the
+    cached sparse operator of build_smoothing_operator on column blocks of the maps. Only one block
+    per worker is held in memory, so `values` and `out` can be memory-mapped arrays.
+    Same output as the former per-vertex loop up to float32 rounding.
     
     Args:
-        graph (networkx.Graph):
+        graph (MeshGraph or networkx.Graph):
             Undirected graph where each node is a vertex on the surface (0..n_vertices-1).
             Edges define adjacency.
-        values (np.ndarray):
+        values (np.ndarray or FactoredSimilarity):
             A 1D or 2D array of shape (n_vertices,) or (n_vertices, n_maps).
+            A FactoredSimilarity is smoothed through its left factor only (O(N*k)).
         iterations (int, optional):
             Number of smoothing iterations (averaging steps). Defaults to 10.
+        out (np.ndarray, optional):
+            Float32 output array (e.g. a np.memmap, or `values` itself for in-place smoothing).
+        block_size (int, optional):
+            Number of maps smoothed at once. Defaults to 1024.
+        n_jobs (int, optional):
+            Number of threads working on column blocks. Defaults to 1.
     
     Returns:
-        np.ndarray:
+        np.ndarray or FactoredSimilarity:
             The smoothed map, with the same shape as `values`:
               - For 1D input: (n_vertices,)
               - For 2D input: (n_vertices, n_maps)
     """
-    # Ensure values are a NumPy array of float32
-    values = np.asarray(values, dtype=np.float32)
+    from concurrent.futures import ThreadPoolExecutor
+    from .similarity_matrix import FactoredSimilarity
+    if isinstance(values, FactoredSimilarity):
+        # Smoothing is linear along the vertices: smooth(L @ R.T) = smooth(L) @ R.T
+        return FactoredSimilarity(smooth_surface_graph(graph, values.left, iterations), values.right)
+    
+    if not hasattr(values, "shape"):
+        values = np.asarray(values, dtype=np.float32)
     n_vertices = values.shape[0]
     
     # Validate that the number of graph nodes matches the number of vertices.
@@ -97,43 +128,32 @@ def smooth_surface_graph(graph, values, iterations=10):
     if values.ndim not in (1, 2):
         raise ValueError("'values' should be either a 1D or 2D array.")
     
-    # Build the adjacency list (each vertex's neighbors)
-    adjacency_list = [[] for _ in range(n_vertices)]
-    for u, v in graph.edges():
-        adjacency_list[u].append(v)
-        adjacency_list[v].append(u)
+    operator = build_smoothing_operator(graph)
     
-    # Prepare working buffers for iterative updates
-    smoothed_map = values.copy()         # current smoothed values
-    new_map = np.zeros_like(smoothed_map)  # buffer for updated values
+    def smooth(block):
+        smoothed_map = np.array(block, dtype=np.float32)
+        for _ in range(iterations):
+            smoothed_map = operator @ smoothed_map
+        return smoothed_map
     
-    # Perform iterative smoothing
-    for _ in range(iterations):
-        if smoothed_map.ndim == 1:
-            # 1D case: each vertex has a single value.
-            for u in range(n_vertices):
-                neighbors = adjacency_list[u]
-                total = smoothed_map[u]  # Always include self.
-                count = 1
-                for v in neighbors:
-                    total += smoothed_map[v]
-                    count += 1
-                new_map[u] = total / count
-        else:
-            # 2D case: each vertex has a vector of values (n_maps)
-            for u in range(n_vertices):
-                neighbors = adjacency_list[u]
-                total = smoothed_map[u, :].copy()  # Include self.
-                count = 1
-                if neighbors:
-                    total += smoothed_map[neighbors, :].sum(axis=0)
-                    count += len(neighbors)
-                new_map[u, :] = total / count
-        
-        # Swap buffers for the next iteration.
-        smoothed_map, new_map = new_map, smoothed_map
-
-    return smoothed_map
+    if values.ndim == 1:
+        smoothed_map = smooth(values)
+        if out is not None:
+            out[:] = smoothed_map
+            return out
+        return smoothed_map
+    
+    n_maps = values.shape[1]
+    if out is None:
+        out = np.empty((n_vertices, n_maps), dtype=np.float32)
+    
+    def run(start):
+        stop = min(start + block_size, n_maps)
+        out[:, start:stop] = smooth(values[:, start:stop])
+    
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        list(pool.map(run, range(0, n_maps, block_size)))
+    return out
 
 
 
@@ -8,37 +8,42 @@ import heapq
 import numpy as np
 import nibabel as nib
 
+from .mesh_graph import as_mesh_graph
+
 
 def find_local_minima(values, graph):
     """
+    Local minima: vertices strictly smaller than all their neighbors (isolated vertices are minima).
+    The smallest neighbor value of every vertex is a segmented min over the CSR neighbor arrays.
+    The minima are listed in node order, which sets the basin ids of watershed_by_flooding.
+
     Args:
         values: (N,) array-like of scalar values (gradient magnitude at each vertex).
-        graph: networkx.Graph where each node corresponds to an index in [0..N-1].
+        graph: MeshGraph (or networkx.Graph) where each node corresponds to an index in [0..N-1].
     
     Returns:
         minima: list of vertex indices that are local minima
     """
-    minima = []
-    for node in graph.nodes():
-        val = values[node]
-        # Check all neighbors
-        is_min = True
-        for nbr in graph.neighbors(node):
-            if values[nbr] <= val:  
-                # <= means we require strictly smaller for "is_min" to remain True
-                # (use < if you want to allow equals)
-                is_min = False
-                break
-        if is_min:
-            minima.append(node)
-    return minima
+    graph = as_mesh_graph(graph)
+    values = np.asarray(values)
+    has_neighbors = graph.degree > 0
+    neighbor_min = np.full(graph.n_vertices, np.inf)
+    if len(graph.indices):
+        neighbor_min[has_neighbors] = np.minimum.reduceat(values[graph.indices],
+                                                          graph.indptr[:-1][has_neighbors])
+    # strictly smaller than every neighbor, in node order
+    is_min = values < neighbor_min
+    return graph.node_order[is_min[graph.node_order]].tolist()
 
 def watershed_by_flooding(graph, values):
     """
     Perform a watershed segmentation on 'values' defined on a mesh graph.
+    Vertices are flooded by increasing value (ties by vertex index), on the CSR neighbor arrays.
+    Neighbors are visited in the mesh graph insertion order, as the networkx implementation did:
+    the first conflicting neighbor stops the flooding from a vertex, so the labels depend on this order.
     
     Args:
-        graph: networkx.Graph where each node is an int in [0..N-1].
+        graph: MeshGraph (or networkx.Graph) where each node is an int in [0..N-1].
         values: (N,) array of floats (e.g., gradient magnitude at each vertex).
         
     Returns:
@@ -47,7 +52,11 @@ def watershed_by_flooding(graph, values):
             -1 = unassigned vertex
             >= 0 = index of the "basin" region
     """
-    n_vertices = graph.number_of_nodes()
+    from array import array
+    graph = as_mesh_graph(graph)
+    n_vertices = graph.n_vertices
+    values = np.asarray(values)
+    indptr, indices = graph.indptr.tolist(), graph.indices.tolist()
     # We'll assume nodes go from 0..(n_vertices-1)
     
     # 1) Find local minima
@@ -57,48 +66,188 @@ def watershed_by_flooding(graph, values):
     #   -2 => boundary
     #   -1 => unassigned
     #   >=0 => basin ID
-    labels = np.full(n_vertices, -1, dtype=int)
+    labels = array('q', [-1]) * n_vertices
     
     # 2) Assign each local minimum a unique label
     for basin_id, idx in enumerate(minima_indices):
         labels[idx] = basin_id
 
-    # 3) Initialize a priority queue (value, vertex_index)
-    pq = []
-    for i in minima_indices:
-        heapq.heappush(pq, (values[i], i))
+    # 3) Priority queue of ranks: rank[v] is the position of v in the (value, vertex) order,
+    #    so the heap holds plain ints and pops in the same order as (value, vertex) tuples
+    order = np.lexsort((np.arange(n_vertices), values))
+    rank = np.empty(n_vertices, dtype=np.int64)
+    rank[order] = np.arange(n_vertices)
+    rank, order = rank.tolist(), order.tolist()
+    pq = [rank[i] for i in minima_indices]
+    heapq.heapify(pq)
 
     # 4) Flooding
     while pq:
-        current_value, current_vertex = heapq.heappop(pq)
+        current_vertex = order[heapq.heappop(pq)]
         
         current_label = labels[current_vertex]
         if current_label < 0:
-            # If it's unassigned or changed, skip
-            continue
-        if current_label == -2:
-            # Already boundary => do not flood from here
+            # If it's unassigned or changed (boundary), skip
             continue
         
         # Check neighbors
-        for nbr in graph.neighbors(current_vertex):
+        for nbr in indices[indptr[current_vertex]:indptr[current_vertex + 1]]:
             nbr_label = labels[nbr]
             
             if nbr_label == -1:
                 # unassigned => adopt current_vertex's label
                 labels[nbr] = current_label
                 # push neighbor into the queue
-                heapq.heappush(pq, (values[nbr], nbr))
+                heapq.heappush(pq, rank[nbr])
             
             elif nbr_label >= 0 and nbr_label != current_label:
                 # Conflict => different basin => mark boundary
                 labels[current_vertex] = -2
                 labels[nbr] = -2
                 # Once marked boundary, we stop flooding from current_vertex
-                # You can break or continue depending on how you want to handle
                 break
     
-    return labels
+    return np.frombuffer(labels, dtype=np.int64).astype(int)
+
+
+
+##################### Hierarchical watershed #####################
+class WatershedTree:
+    """
+    Merge tree of the watershed basins of a map, built by build_watershed_tree.
+    Parcellations at any granularity are cut from it without flooding again.
+
+    Attributes:
+        leaf_labels: (N,) finest basin of each vertex.
+        minima: (n_basins,) vertex of the minimum of each basin.
+        merges: (n_merges, 2) pairs of adjacent basins joined by each merge, by increasing merge height.
+        heights: (n_merges,) value at which each merge happens.
+        saliency: (n_merges,) dynamics of the shallower of the two merged components.
+        dynamics: (n_basins,) saliency of each basin (merge height - minimum value), inf for the deepest basin
+            of each connected component.
+    """
+    def __init__(self, graph, leaf_labels, minima, merges, heights, saliency, dynamics):
+        self.graph = graph
+        self.leaf_labels = leaf_labels
+        self.minima = minima
+        self.merges = merges
+        self.heights = heights
+        self.saliency = saliency
+        self.dynamics = dynamics
+
+    @property
+    def n_basins(self):
+        return len(self.minima)
+
+    def cut(self, n_parcels=None, saliency=None, mark_boundaries=False):
+        """
+        Parcellation with n_parcels parcels (at least one per connected component of the mesh),
+        or merging all the components whose dynamics is below saliency.
+
+        Args:
+            n_parcels (int, optional): number of parcels.
+            saliency (float, optional): merges with a smaller saliency are applied.
+            mark_boundaries (bool, optional): label -2 both vertices of the edges joining two parcels.
+        Returns:
+            labels: (N,) array of parcel ids 0..(n_parcels-1) (and -2 boundaries if marked).
+        """
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        if (n_parcels is None) == (saliency is None):
+            raise ValueError("Give either n_parcels or saliency")
+        if n_parcels is not None:
+            # Every undone merge adds one parcel: undo the most salient ones (ties by merge order)
+            n_roots = self.n_basins - len(self.merges)
+            ranking = np.lexsort((np.arange(len(self.merges)), -self.saliency))
+            applied = np.ones(len(self.merges), dtype=bool)
+            applied[ranking[:max(n_parcels - n_roots, 0)]] = False
+        else:
+            applied = self.saliency < saliency
+        # Parcels are the connected components of the basins joined by the applied merges
+        joined = self.merges[applied]
+        forest = coo_matrix((np.ones(len(joined)), (joined[:, 0], joined[:, 1])),
+                            shape=(self.n_basins, self.n_basins))
+        _, basin_parcel = connected_components(forest, directed=False)
+        labels = basin_parcel[self.leaf_labels]
+        if mark_boundaries:
+            edges = self.graph.unique_edges
+            cut = labels[edges[:, 0]] != labels[edges[:, 1]]
+            labels[edges[cut].ravel()] = -2
+        return labels
+
+
+def build_watershed_tree(graph, values):
+    """
+    Flood the map once and record the basin merge tree (union-find by increasing value, ties by vertex index).
+    A vertex without processed neighbor starts a basin, the other vertices join the basin of their lowest
+    neighbor. When components meet at a vertex, the shallower ones die with dynamics
+    (meeting value - their minimum value) and the merge joins two basins touching at that vertex,
+    so that every cut of the tree gives connected parcels.
+
+    Args:
+        graph: MeshGraph (or networkx.Graph) where each node is an int in [0..N-1].
+        values: (N,) array of floats (e.g., gradient magnitude at each vertex).
+    Returns:
+        WatershedTree
+    """
+    graph = as_mesh_graph(graph)
+    n_vertices = graph.n_vertices
+    values = np.asarray(values)
+    indptr, indices = graph.indptr.tolist(), graph.indices.tolist()
+    order = np.lexsort((np.arange(n_vertices), values))
+    rank = np.empty(n_vertices, dtype=np.int64)
+    rank[order] = np.arange(n_vertices)
+    rank = rank.tolist()
+    value_list = values.tolist()
+
+    leaf = [-1] * n_vertices      # finest basin of each processed vertex
+    parent = []                   # union-find over basins, a root is the deepest basin of its component
+    minima = []
+    merges, heights, saliency = [], [], []
+    dynamics = []
+
+    def find(basin):
+        while parent[basin] != basin:
+            parent[basin] = parent[parent[basin]]
+            basin = parent[basin]
+        return basin
+
+    for vertex in order.tolist():
+        # Lowest processed neighbor of each neighboring component
+        contact = {}
+        for nbr in indices[indptr[vertex]:indptr[vertex + 1]]:
+            if leaf[nbr] >= 0:
+                root = find(leaf[nbr])
+                if root not in contact or rank[nbr] < rank[contact[root]]:
+                    contact[root] = nbr
+        if not contact:
+            # New basin
+            basin = len(minima)
+            leaf[vertex] = basin
+            parent.append(basin)
+            minima.append(vertex)
+            dynamics.append(np.inf)
+            continue
+        lowest = min(contact.values(), key=lambda v: rank[v])
+        leaf[vertex] = leaf[lowest]
+        if len(contact) > 1:
+            # Components meet: the deepest survives
+            roots = sorted(contact, key=lambda r: rank[minima[r]])
+            for dying in roots[1:]:
+                parent[dying] = roots[0]
+                dynamics[dying] = value_list[vertex] - value_list[minima[dying]]
+                merges.append((leaf[vertex], leaf[contact[dying]]) if leaf[vertex] != leaf[contact[dying]]
+                              else (leaf[vertex], leaf[contact[roots[0]]]))
+                heights.append(value_list[vertex])
+                saliency.append(dynamics[dying])
+
+    return WatershedTree(graph,
+                         np.array(leaf, dtype=np.int64),
+                         np.array(minima, dtype=np.int64),
+                         np.array(merges, dtype=np.int64).reshape(-1, 2),
+                         np.array(heights, dtype=np.float64),
+                         np.array(saliency, dtype=np.float64),
+                         np.array(dynamics, dtype=np.float64))
 
 
 
@@ -112,7 +261,7 @@ def non_maxima_suppression(graph,
     Apply non-maxima suppression to identify edge vertices.
     
     Args:
-        graph: networkx.Graph object
+        graph: MeshGraph (or networkx.Graph) object
         gradient_map: ndarray of shape (n_vertices,)
         min_neighbors: int, number of non-adjacent maxima required
     
@@ -123,8 +272,9 @@ def non_maxima_suppression(graph,
     min_grad_value = np.percentile(gradient_map, 100*threshold)
     # Initialize the edge map
     edge_map = np.zeros_like(gradient_map, dtype=bool)
-    for vertex in graph.nodes:
-        neighbors = list(graph.neighbors(vertex))
+    graph = as_mesh_graph(graph)
+    for vertex in range(graph.n_vertices):
+        neighbors = graph.indices[graph.indptr[vertex]:graph.indptr[vertex + 1]]
         if len(neighbors) < min_neighbors:
             continue
         # Check if current vertex is a local maximum
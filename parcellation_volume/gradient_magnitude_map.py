@@ -10,17 +10,114 @@ contact : robin.junod@epfl.ch
 """
 # modified by Robin Junod
 #%%
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.ndimage import gaussian_filter
 
     
 # GRADIENT MAGNITUDE MAP CUSTOM METHOD
+# Neighborhood operators already built, keyed by (ROI positions, offsets, weights), least recently used first.
+# Bounded so that a loop over subjects/ROIs does not keep every operator alive.
+_NEIGHBOR_OPERATORS = OrderedDict()
+_NEIGHBOR_OPERATORS_MAXSIZE = 4
+_NEIGHBOR_OPERATORS_LOCK = threading.Lock()
+
+def gaussian_offsets(radius=3, sigma=3.0):
+    """Offsets of the cube of given radius (center excluded) with their Gaussian weights, negligible weights removed.
+    Returns:
+        offsets (np.ndarray): (k, 3) int offsets
+        weights (np.ndarray): (k,) weights exp(-d^2 / (2 sigma^2)) > 1e-6
+    """
+    r = np.arange(-radius, radius + 1)
+    offsets = np.stack(np.meshgrid(r, r, r, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets = offsets[np.any(offsets != 0, axis=1)]  # Skip the center voxel
+    weights = np.exp(-np.sum(offsets**2, axis=1) / (2 * sigma**2))
+    keep = weights > 1e-6  # Ignore negligible weights
+    return offsets[keep], weights[keep]
+
+
+def neighbor_weight_operator(spatial_position, offsets, weights=None):
+    """Sparse (n_voxels, n_voxels) matrix W with W[i, j] = weight of the offset from voxel i to voxel j,
+    for all the pairs of ROI voxels separated by one of the offsets. The last _NEIGHBOR_OPERATORS_MAXSIZE
+    (ROI, neighborhood) operators are cached.
+    Args:
+        spatial_position (tuple): (x, y, z) coordinates of the ROI voxels.
+        offsets (np.ndarray): (k, 3) integer offsets (symmetric set).
+        weights (np.ndarray, optional): (k,) weights. Defaults to 1.
+    Returns:
+        scipy.sparse.csr_matrix: W
+    """
+    import hashlib
+    from scipy.sparse import csr_matrix
+    coords = np.stack([np.asarray(c, dtype=np.int64).ravel() for c in spatial_position], axis=1)
+    offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 3)
+    weights = np.ones(len(offsets)) if weights is None else np.asarray(weights, dtype=np.float64)
+    key = hashlib.sha1(coords.tobytes() + offsets.tobytes() + weights.tobytes()).hexdigest()
+    with _NEIGHBOR_OPERATORS_LOCK:
+        if key in _NEIGHBOR_OPERATORS:
+            _NEIGHBOR_OPERATORS.move_to_end(key)
+            return _NEIGHBOR_OPERATORS[key]
+    
+    n_voxels = len(coords)
+    # Index volume with a margin so that every offset stays inside
+    margin = int(np.abs(offsets).max(initial=0))
+    origin = coords.min(axis=0, initial=0) - margin
+    index_volume = -np.ones(tuple(coords.max(axis=0, initial=0) - origin + margin + 1), dtype=np.int64)
+    local = coords - origin
+    index_volume[tuple(local.T)] = np.arange(n_voxels)
+    rows, cols, data = [], [], []
+    for offset, weight in zip(offsets, weights):
+        neighbor = index_volume[tuple((local + offset).T)]
+        inside = neighbor >= 0
+        rows.append(np.flatnonzero(inside))
+        cols.append(neighbor[inside])
+        data.append(np.full(inside.sum(), weight))
+    W = csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                   shape=(n_voxels, n_voxels))
+    with _NEIGHBOR_OPERATORS_LOCK:
+        _NEIGHBOR_OPERATORS[key] = W
+        while len(_NEIGHBOR_OPERATORS) > _NEIGHBOR_OPERATORS_MAXSIZE:
+            _NEIGHBOR_OPERATORS.popitem(last=False)
+    return W
+
+
+def _weighted_neighbor_distance(sim_matrix, W, block_size=256):
+    """For every voxel i: sum_j W[i, j] * ||sim_matrix[i] - sim_matrix[j]|| and sum_j W[i, j].
+    Only the pairs i < j are computed (W is symmetric) with ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b,
+    the dot products of a block of rows with the (spatially close, hence close in index) columns
+    of its neighbors being one matrix product."""
+    from scipy.sparse import triu, csr_matrix
+    sim_matrix = np.asarray(sim_matrix, dtype=np.float64)
+    squared_norms = np.square(sim_matrix).sum(axis=1)
+    upper = triu(W, k=1).tocsr()
+    distances = np.zeros(upper.nnz)
+    for r0 in range(0, upper.shape[0], block_size):
+        r1 = min(r0 + block_size, upper.shape[0])
+        p0, p1 = upper.indptr[r0], upper.indptr[r1]
+        if p0 == p1:
+            continue
+        rows = np.repeat(np.arange(r0, r1), np.diff(upper.indptr[r0:r1 + 1]))
+        cols = upper.indices[p0:p1]
+        c0, c1 = cols.min(), cols.max() + 1
+        dots = (sim_matrix[r0:r1] @ sim_matrix[c0:c1].T)[rows - r0, cols - c0]
+        distances[p0:p1] = np.sqrt(np.maximum(squared_norms[rows] + squared_norms[cols] - 2 * dots, 0))
+    D = csr_matrix((upper.data * distances, upper.indices, upper.indptr), shape=W.shape)
+    D = D + D.T
+    weighted_distance = np.asarray(D.sum(axis=1)).ravel()
+    total_weight = np.asarray(W.sum(axis=1)).ravel()
+    return weighted_distance, total_weight
+
+
 def custom_gradient_map(sim_matrix,
                          spatial_position,
                          roi_data_shape) -> np.ndarray:
     """Compute the gradient map from a similarity matrix using diffusion embedding.
     the gradient map is a 3D map of brain highligting place with similar connectivity.
+    Each voxel gets the mean distance between its similarity vector and the ones of its
+    6 face neighbours in the ROI (computed with a sparse neighbour operator).
     
     Args:
         sim_matrix (np.array): Computed from the similarity matrix
@@ -31,29 +128,15 @@ def custom_gradient_map(sim_matrix,
         np.ndarray: Gradient magnitude map
     """
     print('Computing gradient map...')
-    # Unpack the spatial positions
-    n_voxels = sim_matrix.shape[0]
-    x_coords, y_coords, z_coords = spatial_position
-    coord_to_index = {
-        (x_coords[i], y_coords[i], z_coords[i]): i for i in range(len(x_coords))
-    }
+    offsets = np.array([(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)])
+    W = neighbor_weight_operator(spatial_position, offsets)
+    rmse, num_neighbours = _weighted_neighbor_distance(sim_matrix, W)
+    # Voxels whose similarity vector contains a zero are skipped
+    valid = np.all(sim_matrix, axis=1) & (num_neighbours > 0)
     # initialize the gradient magnitude array
     gradient_magnitude_map = np.zeros(roi_data_shape)
-    # search for neighbours in the 3D space
-    for i in range(n_voxels):
-        x, y, z = x_coords[i], y_coords[i], z_coords[i]
-        if sim_matrix[i].all() == 0:
-            continue
-        num_neighbours = 0
-        rmse = 0
-        for dx, dy, dz in [(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)]:
-            new_x, new_y, new_z = x + dx, y + dy, z + dz
-            if (new_x, new_y, new_z) in coord_to_index:
-                j = coord_to_index[(new_x, new_y, new_z)]
-                rmse += np.linalg.norm(sim_matrix[i] - sim_matrix[j])
-                num_neighbours += 1
-        if num_neighbours > 0:
-            gradient_magnitude_map[x, y, z] = rmse / num_neighbours
+    x_coords, y_coords, z_coords = (np.asarray(c).ravel() for c in spatial_position)
+    gradient_magnitude_map[x_coords[valid], y_coords[valid], z_coords[valid]] = rmse[valid] / num_neighbours[valid]
     return gradient_magnitude_map 
 
 def custom_gradient_map_gaussian(sim_matrix,
@@ -63,54 +146,27 @@ def custom_gradient_map_gaussian(sim_matrix,
                                   radius=3) -> np.ndarray:
     """Compute the gradient map from a similarity matrix using a Gaussian-weighted neighborhood.
     The gradient map is a 3D map highlighting places with similar connectivity.
+    The neighborhood is a sparse voxel-voxel weight matrix (cached per ROI), any radius and sigma can be used.
 
     Args:
         sim_matrix (np.array): Computed from the similarity matrix.
         spatial_position (tuple): Given by the function compute_similarity_matrix_in_ROI.
         roi_data_shape (tuple): Shape of the ROI data (should be 3D).
-        sigma (float, optional): Standard deviation of the Gaussian kernel. Defaults to 1.0.
+        sigma (float, optional): Standard deviation of the Gaussian kernel. Defaults to 3.0.
         radius (int, optional): Radius of the neighborhood to consider. Defaults to 3.
 
     Returns:
         np.ndarray: Gradient magnitude map.
     """
     print('Computing gradient map with Gaussian-weighted neighborhood...')
-    # Unpack the spatial positions
-    n_voxels = sim_matrix.shape[0]
-    x_coords, y_coords, z_coords = spatial_position
-    coord_to_index = {
-        (x_coords[i], y_coords[i], z_coords[i]): i for i in range(n_voxels)
-    }
+    W = neighbor_weight_operator(spatial_position, *gaussian_offsets(radius, sigma))
+    weighted_rmse, total_weight = _weighted_neighbor_distance(sim_matrix, W)
+    # Skip the voxels whose similarity vector is all zeros
+    valid = np.any(sim_matrix, axis=1) & (total_weight > 0)
     # Initialize the gradient magnitude array
     gradient_magnitude_map = np.zeros(roi_data_shape)
-    # Precompute the possible offsets and their Gaussian weights
-    offsets = []
-    for dx in range(-radius, radius + 1):
-        for dy in range(-radius, radius + 1):
-            for dz in range(-radius, radius + 1):
-                if dx == 0 and dy == 0 and dz == 0:
-                    continue  # Skip the center voxel
-                distance_squared = dx**2 + dy**2 + dz**2
-                weight = np.exp(-distance_squared / (2 * sigma**2))
-                if weight > 1e-6:  # Ignore negligible weights
-                    offsets.append((dx, dy, dz, weight))
-    # Compute the gradient magnitude map
-    for idx in range(n_voxels):
-        x_i, y_i, z_i = x_coords[idx], y_coords[idx], z_coords[idx]
-        if not np.any(sim_matrix[idx]):
-            continue  # Skip if the similarity vector is all zeros
-        weighted_rmse = 0.0
-        total_weight = 0.0
-        for dx, dy, dz, weight in offsets:
-            x_j, y_j, z_j = x_i + dx, y_i + dy, z_i + dz
-            # Check if the neighbor voxel is within the ROI
-            if (x_j, y_j, z_j) in coord_to_index:
-                jdx = coord_to_index[(x_j, y_j, z_j)]
-                diff = np.linalg.norm(sim_matrix[idx] - sim_matrix[jdx])
-                weighted_rmse += weight * diff
-                total_weight += weight
-        if total_weight > 0:
-            gradient_magnitude_map[x_i, y_i, z_i] = weighted_rmse / total_weight
+    x_coords, y_coords, z_coords = (np.asarray(c).ravel() for c in spatial_position)
+    gradient_magnitude_map[x_coords[valid], y_coords[valid], z_coords[valid]] = weighted_rmse[valid] / total_weight[valid]
     
     return gradient_magnitude_map
 
@@ -225,6 +281,53 @@ def compute_gradient_inside_ROI(volume,
     return gradient_magnitude, (gx, gy, gz)
 
 
+def nearest_roi_indices(roi_mask):
+    """Indices (3, x, y, z) of the nearest ROI voxel of every voxel (distance transform of the ROI complement).
+    Depends only on the ROI, so it is computed once for all the similarity maps."""
+    from scipy.ndimage import distance_transform_edt
+    return distance_transform_edt(~roi_mask.astype(bool), return_indices=True, return_distances=False)
+
+
+def _sobel_batch(volumes, axis):
+    """scipy.ndimage.sobel along a spatial axis of a (batch, x, y, z) array, without smoothing across the batch axis"""
+    from scipy.ndimage import correlate1d
+    output = correlate1d(volumes, [-1, 0, 1], axis=axis, mode='constant')
+    for other in (1, 2, 3):
+        if other != axis:
+            correlate1d(output, [1, 2, 1], axis=other, output=output, mode='constant')
+    return output
+
+
+def compute_gradient_inside_ROI_batch(volumes,
+                                      roi_mask,
+                                      indices=None):
+    """
+    Batched version of compute_gradient_inside_ROI for a stack of volumes sharing the same ROI.
+
+    Parameters:
+    - volumes (np.ndarray): (batch, x, y, z) array of volumes.
+    - roi_mask (np.ndarray): 3D boolean array where True indicates the ROI.
+    - indices (np.ndarray, optional): nearest_roi_indices(roi_mask), computed if not given.
+
+    Returns:
+    - gradient_magnitude (np.ndarray): (batch, x, y, z) gradient magnitudes within the ROI.
+    - (gx, gy, gz) (np.ndarray): (batch, x, y, z) gradient components within the ROI.
+    """
+    roi_mask = roi_mask.astype(bool)
+    if indices is None:
+        indices = nearest_roi_indices(roi_mask)
+    # Step 1: Replace values outside the ROI with the nearest ROI value (one fancy-index for the whole batch)
+    padded_volumes = volumes[:, indices[0], indices[1], indices[2]]
+    # Step 2: Sobel along the spatial axes
+    gx, gy, gz = (_sobel_batch(padded_volumes, axis) for axis in (1, 2, 3))
+    # Step 3: Gradient magnitude, masked to the ROI
+    outside = ~roi_mask
+    gradient_magnitude = np.sqrt(gx**2 + gy**2 + gz**2)
+    for array in (gradient_magnitude, gx, gy, gz):
+        array[:, outside] = 0
+    return gradient_magnitude, (gx, gy, gz)
+
+
 # APPLY GAUSSIAN BLURRING
 def gaussian_blurring(volume_scalar : np.array,
                       sigma : float = 1):
@@ -243,14 +346,16 @@ def gaussian_blurring(volume_scalar : np.array,
 def non_maxima_suppression_3d(gradient_magnitude, gx, gy, gz, roi_mask):
     """
     Perform 3D Non-Maxima Suppression on the gradient magnitude within a ROI.
+    All the ROI voxels (and all the maps of a batch) are processed at once: the gradient
+    magnitude is interpolated at the two neighbor positions with one map_coordinates call per side.
 
     Parameters:
-    - gradient_magnitude (np.ndarray): 3D array of gradient magnitudes.
-    - gx, gy, gz (np.ndarray): 3D arrays of gradient components along x, y, z axes.
+    - gradient_magnitude (np.ndarray): 3D array of gradient magnitudes, or (batch, x, y, z) for a batch of maps.
+    - gx, gy, gz (np.ndarray): gradient components along x, y, z axes (same shape as gradient_magnitude).
     - roi_mask (np.ndarray): 3D boolean array where True indicates the ROI.
 
     Returns:
-    - nms (np.ndarray): 3D array after non-maxima suppression.
+    - nms (np.ndarray): array after non-maxima suppression (same shape as gradient_magnitude).
     """
     from scipy.ndimage import map_coordinates
     # Ensure inputs are float for precision
@@ -259,57 +364,51 @@ def non_maxima_suppression_3d(gradient_magnitude, gx, gy, gz, roi_mask):
     gy = gy.astype(np.float32)
     gz = gz.astype(np.float32)
     roi_mask = roi_mask.astype(bool)
+    batched = gradient_magnitude.ndim == 4
+    if not batched:
+        gradient_magnitude, gx, gy, gz = (a[None] for a in (gradient_magnitude, gx, gy, gz))
     
     # Initialize the output array
     nms = np.zeros_like(gradient_magnitude)
     
-    # Get the indices of all voxels within the ROI
-    indices = np.array(np.nonzero(roi_mask)).T  # Shape: (num_voxels, 3)
+    # Indices of all voxels within the ROI, for every map of the batch
+    x, y, z = np.nonzero(roi_mask)
+    b = np.repeat(np.arange(gradient_magnitude.shape[0]), len(x))
+    x, y, z = (np.tile(c, gradient_magnitude.shape[0]) for c in (x, y, z))
+    # Gradient vectors, voxels without direction are skipped
+    g_x, g_y, g_z = gx[b, x, y, z], gy[b, x, y, z], gz[b, x, y, z]
+    norm = np.sqrt(g_x**2 + g_y**2 + g_z**2)
+    keep = norm != 0
+    b, x, y, z, norm = b[keep], x[keep], y[keep], z[keep], norm[keep]
+    # Normalize the gradient vectors
+    g = np.stack([g_x[keep] / norm, g_y[keep] / norm, g_z[keep] / norm])
     
-    for idx in indices:
-        x, y, z = idx
-        # Get the gradient vector at this voxel
-        g_x = gx[x, y, z]
-        g_y = gy[x, y, z]
-        g_z = gz[x, y, z]
-        
-        # Normalize the gradient vector
-        norm = np.sqrt(g_x**2 + g_y**2 + g_z**2)
-        if norm == 0:
-            continue  # Cannot determine direction; skip
-        g_x /= norm
-        g_y /= norm
-        g_z /= norm
-        
-        # Determine the two neighboring voxel positions
-        neighbor1 = [x + g_x, y + g_y, z + g_z]
-        neighbor2 = [x - g_x, y - g_y, z - g_z]
-        
-        # Check boundaries
-        if (0 <= neighbor1[0] < gradient_magnitude.shape[0] - 1 and
-            0 <= neighbor1[1] < gradient_magnitude.shape[1] - 1 and
-            0 <= neighbor1[2] < gradient_magnitude.shape[2] - 1 and
-            0 <= neighbor2[0] < gradient_magnitude.shape[0] - 1 and
-            0 <= neighbor2[1] < gradient_magnitude.shape[1] - 1 and
-            0 <= neighbor2[2] < gradient_magnitude.shape[2] - 1):
-            
-            # Interpolate gradient magnitudes at the neighboring positions
-            gm1 = map_coordinates(gradient_magnitude, 
-                                  [[neighbor1[0]], [neighbor1[1]], [neighbor1[2]]], 
-                                  order=1, mode='nearest')[0]
-            gm2 = map_coordinates(gradient_magnitude, 
-                                  [[neighbor2[0]], [neighbor2[1]], [neighbor2[2]]], 
-                                  order=1, mode='nearest')[0]
-            
-            # Suppress if not a local maximum
-            if gradient_magnitude[x, y, z] >= gm1 and gradient_magnitude[x, y, z] >= gm2:
-                nms[x, y, z] = gradient_magnitude[x, y, z]
+    # Determine the two neighboring voxel positions
+    position = np.stack([x, y, z])
+    neighbor1 = position + g
+    neighbor2 = position - g
+    # Check boundaries
+    upper = np.array(gradient_magnitude.shape[1:])[:, None] - 1
+    inside = ((neighbor1 >= 0) & (neighbor1 < upper) & (neighbor2 >= 0) & (neighbor2 < upper)).all(axis=0)
+    b, position = b[inside], position[:, inside]
+    neighbor1, neighbor2 = neighbor1[:, inside], neighbor2[:, inside]
     
-    return nms
+    # Interpolate gradient magnitudes at the neighboring positions (exact integer coordinate on the batch axis)
+    gm1 = map_coordinates(gradient_magnitude, np.vstack([b, neighbor1]), order=1, mode='nearest')
+    gm2 = map_coordinates(gradient_magnitude, np.vstack([b, neighbor2]), order=1, mode='nearest')
+    
+    # Suppress if not a local maximum
+    gm = gradient_magnitude[b, position[0], position[1], position[2]]
+    maxima = (gm >= gm1) & (gm >= gm2)
+    nms[b[maxima], position[0][maxima], position[1][maxima], position[2][maxima]] = gm[maxima]
+    
+    return nms if batched else nms[0]
 
 def pipeline_wig2014(sim_mtrx,
                      spatial_position,
-                     volumne_shape : tuple=(91,109,91)):
+                     volumne_shape : tuple=(91,109,91),
+                     batch_size : int=32,
+                     n_jobs : int=1):
     """This compute for a single subject the gradient magnitude map.
     This map highlights the zone of the brain with a similar activity.
 
@@ -317,6 +416,8 @@ def pipeline_wig2014(sim_mtrx,
         sim_mtrx (np.array): The similarity matrix. each columns or row is a similarity map
         spatial_position (np.array): A 3xn array of the spatial position of the voxel. 
                                     Each column is a voxel position.
+        batch_size (int, optional): number of similarity maps processed together. Defaults to 32.
+        n_jobs (int, optional): number of threads working on batches. Defaults to 1.
     
     Returns:
         edge_maps_mean (np.array): The mean edge map of the similarity maps.
@@ -344,22 +445,28 @@ def pipeline_wig2014(sim_mtrx,
     # Initialize a mask for the region of interest
     roi_adjusted = np.zeros((size_x, size_y, size_z))
     roi_adjusted[x_adjusted, y_adjusted, z_adjusted] = 1
-    # Initialize the edge map
-    edge_maps_mean = np.zeros_like(roi_adjusted)
-    # loop across each columns in sim matrix (coressponding to a sim map)
-    for sim_map_id in range(sim_mtrx.shape[0]):
-        # Extract a similarty map
-        sim_map_flat = sim_mtrx[:,sim_map_id]
-        # transform the sim map in 3D
-        sim_map_3d = flat2volum(sim_map_flat, position_adjusted)
+    roi_adjusted = roi_adjusted.astype(bool)
+    # The nearest-ROI map used for padding is the same for every similarity map
+    indices = nearest_roi_indices(roi_adjusted)
+    n_maps = sim_mtrx.shape[0]
+    
+    def edge_map_sum(start):
+        """Sum of the edge maps of the similarity maps start ... start+batch_size-1"""
+        # Extract the similarity maps (columns of sim matrix) and transform them in 3D
+        sim_maps = np.asarray(sim_mtrx[:, start:min(start + batch_size, n_maps)]).T
+        sim_maps_3d = np.zeros((len(sim_maps), size_x, size_y, size_z), dtype=sim_maps.dtype)
+        sim_maps_3d[:, x_adjusted, y_adjusted, z_adjusted] = sim_maps
         # TODO : compare without blurring the sim map
-        # sim_map_3d_blurr = gaussian_blurring(sim_map_3d, sigma=1)
-        # Compute the gradient magnitude map
-        grad_map, (gx,gy,gz) = compute_gradient_inside_ROI(sim_map_3d, roi_adjusted)
-        # Detect edges form sim_map
-        edge_map = non_maxima_suppression_3d(grad_map, gx, gy, gz , roi_adjusted)
-        # Compute the mean edge map
-        edge_maps_mean = edge_maps_mean + edge_map/sim_mtrx.shape[0]
+        # sim_maps_3d = gaussian_blurring(sim_maps_3d, sigma=(0, 1, 1, 1))
+        # Compute the gradient magnitude maps
+        grad_maps, (gx, gy, gz) = compute_gradient_inside_ROI_batch(sim_maps_3d, roi_adjusted, indices)
+        # Detect edges form sim_maps
+        edge_maps = non_maxima_suppression_3d(grad_maps, gx, gy, gz, roi_adjusted)
+        return edge_maps.sum(axis=0, dtype=np.float64)
+    
+    # Compute the mean edge map, batches of similarity maps in parallel
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        edge_maps_mean = sum(pool.map(edge_map_sum, range(0, n_maps, batch_size))) / n_maps
     
     
     # Place the edge map back in the original volume
@@ -10,7 +10,7 @@ import scipy.io
 import matplotlib.pyplot as plt
 
 from toolbox_parcellation import extract_4Ddata_from_nii, extract_3Ddata_from_nii, expand_mask\
-                                ,extract_nii_files
+                                ,extract_nii_files, positive_variance_mask
 
 from gradient_magnitude_map import custom_gradient_map_gaussian, \
                                     pipeline_wig2014
@@ -26,13 +26,12 @@ from watershed_by_flooding import watershed_by_flooding, find_seeds
 
 def preprocess_ROI_data(roi_mask: np.ndarray,
                         brain_mask: np.ndarray,
-                        fmri_data: np.ndarray) -> np.ndarray:
-    """Preprocess the ROI data"""
+                        fmri_data) -> np.ndarray:
+    """Preprocess the ROI data (fmri_data: 4D array or nibabel image, read by slabs)"""
     # Keep only the ROI voxels inside the mask
     roi_mask = roi_mask * brain_mask
     # Keep only the ROI voxels that have positive variace in the fMRI data
-    voxel_variances = np.var(fmri_data, axis=3)
-    roi_mask = roi_mask * (voxel_variances > 0)
+    roi_mask = roi_mask * positive_variance_mask(fmri_data, roi_mask)
     return roi_mask
 
 
@@ -44,8 +43,9 @@ def compute_and_save_singlesub(subject_id: str,
                                 outdir_grad_map: str,
                                 outdir_sim_mtrx: str,
                                 outdir_parcel: str):
-    # extract data and affine transformation matrix
-    fmri_data, roi_mask, brain_mask, original_affine = extract_nii_files(fmri_path, roi_mask_path, brain_mask_path, output_dir)
+    # extract data and affine transformation matrix (the fMRI stays a nibabel image, its mask voxels are read by slabs)
+    fmri_data, roi_mask, brain_mask, original_affine = extract_nii_files(fmri_path, roi_mask_path, brain_mask_path, output_dir,
+                                                                         load_fmri=False)
     # Expand the mask size to avoid border issues with the gradient map
     extended_roi_mask = expand_mask(roi_mask, expansion_voxels=3)
     
@@ -55,10 +55,10 @@ def compute_and_save_singlesub(subject_id: str,
         print('mask shape,' , brain_mask.shape)
         print('roi shape,' , roi_mask.shape)
         sys.exit('Data dimensions do not match. Exiting.')
-    # Preprocess the ROI data
+    # Preprocess the ROI data (one pass over the fMRI file: the ROI is inside the extended ROI)
     print('Preprocessing the ROI data...')
     extended_roi_mask = preprocess_ROI_data(extended_roi_mask, brain_mask, fmri_data)
-    roi_mask = preprocess_ROI_data(roi_mask, brain_mask, fmri_data)
+    roi_mask = roi_mask * extended_roi_mask
     print('ROI data preprocessed.')
     nVoxels = np.prod(extended_roi_mask.shape)
 
@@ -3,87 +3,72 @@ import os
 import sys
 import scipy
 import numpy as np
-from toolbox_parcellation import pca, corr, eta2
+from toolbox_parcellation import pca, corr, eta2, load_masked_timeseries
 
 
-def fingerprint_simmatrix_in_ROI(fmri_data: np.ndarray,
+def fingerprint_simmatrix_in_ROI(fmri_data,
                                 roi_data: np.ndarray,
                                 mask_data: np.ndarray,
-                                save_simmatrix=True) -> np.ndarray:
+                                save_simmatrix=True,
+                                slab_size=8) -> np.ndarray:
     
-    """Compute the similarity matrix for fMRI data based on connectivity fingerprints"""
+    """Compute the similarity matrix for fMRI data based on connectivity fingerprints.
+    Only the voxels of the mask are read (by slabs) and z-scored, in float32.
+    Args:
+        fmri_data (np.ndarray | nib.Nifti1Image | str): 4D fmri data, image or path to it.
+        roi_data (np.ndarray): 3D roi data (must be inside the mask)
+        mask_data (np.ndarray): 3D brain mask
+        slab_size (int, optional): number of z-planes read at once. Defaults to 8.
+    Returns:
+        S (np.ndarray): (n_roi, n_roi) similarity matrix
+        spatial_position (tuple): np.where(roi_data > 0)
+    """
     #TODO : VERIFY IF THIS APPROCHES ONLY MAKES ONE CORRELATION MATRIX OR DOES IT MAKE THE 
     # CORRELATION MATRIX OF THE CORRELATION MATRIX TO GET MORE CONECTIVITY INFORMATIONS.
-	# Store the dimensions of the roi data and fmri data for later use
-    roidims = roi_data.shape
-    nVoxels = np.prod(roidims)
-    nFrames = fmri_data.shape[3]
-    
-    # Reshape roi into a vector of size nVoxels
-    mask_flatten = np.reshape(mask_data,(nVoxels))
-    # Check if roi inside of mask
-    roi_flatten = np.reshape(roi_data,(nVoxels))
-    # Reshape fmri data into a matrix of size nVoxels x n
-    fmri_flatten = np.reshape(fmri_data,(nVoxels,nFrames))
-    fmri_flatten = fmri_flatten.astype(np.float32)
-    
+    roi = np.asarray(roi_data) > 0
+    mask = np.asarray(mask_data) > 0
     # Verfiy that the data is good
-    if (roi_flatten != roi_flatten * mask_flatten).any(): # Verify the ROI is inside the mask
+    if (roi & ~mask).any(): # Verify the ROI is inside the mask
         sys.exit('ROI is not inside the mask. Exiting. (use roi_flatten = roi_flatten * mask_flatten)')
-    if (roi_flatten != roi_flatten * (np.var(fmri_flatten, axis=1) > 0)).any(): # Verify the ROI has positive variance
-        sys.exit('ROI contains voxels without variance. Exiting. (use roi_flatten = roi_flatten * (np.var(fmri_flatten, axis=1) > 0)')
-        
-    # Find the indices inside roi
-    roiIndices1D = np.where(roi_flatten > 0)
-    spatial_position = np.where(roi_data > 0)
-    # Find the indices outside roi but inside mask
-    maskIndices = np.where((roi_flatten==0) & (mask_flatten>0)) 
-
-    # Initialise similarity matrix
-    S = np.zeros([np.sum(roi_flatten>0),np.sum(roi_flatten>0)])
     
-    # Normalise the data
-    fmri_normalized = (fmri_flatten - np.mean(fmri_flatten, axis=1, keepdims=True)) / np.std(fmri_flatten, axis=1, keepdims=True)
+    # Normalised data of the mask voxels (C order of np.where)
+    Z, valid = load_masked_timeseries(fmri_data, mask, slab_size=slab_size)
+    in_roi = roi[mask]
+    if not valid[in_roi].all(): # Verify the ROI has positive variance
+        sys.exit('ROI contains voxels without variance. Exiting. (use roi_flatten = roi_flatten * (np.var(fmri_flatten, axis=1) > 0)')
     
-    # Gather data inside roi
-    A = fmri_normalized[roiIndices1D,:][0]
+    # Data inside roi, and outside roi but inside mask. Voxels without variance
+    # in the mask are ignored.
+    if not valid[~in_roi].all():
+        print('WARNING: Mask includes voxels without variance.')
+    A = Z[in_roi]
+    B = Z[~in_roi & valid]
+    del Z
+    spatial_position = np.where(roi)
     
-    # If the roi contains invalid data it must be due to a division by 0 (stdev)
-    # since the data themselves do not contain nans or infs. If so, we terminate 
-    # the program and the user should define a roi covering functional data.
-    # TODO : this part is now automatically taken care of by removing voxels
-    # with 0 variance in the roi with the preprocesing func.
-    if np.any(np.isnan(A)) or np.any(np.isinf(A)):
-        print('WARNING : ROI includes ',
-        np.isinf(np.var(A, axis=1)).sum() + np.isnan(np.var(A, axis=1)).sum(),
-        ' voxels without variance.\nExiting.')
-        
-    # Gather data outside roi
-    B = fmri_normalized[maskIndices,:][0]
+    S = fingerprint_simmatrix(A, B)
+    return S, spatial_position
 
-    # Transpose so that the data are stored in a time x space matrix
-    A = A.T
-    B = B.T
 
-    # A division by 0 (stdev) can also lead to nans and infs in the mask data.
-    # In this case we can simply throw a warning and ignore all voxels without
-    # variance.
-    keepB = ~np.isnan(B).any(axis=0) & ~np.isinf(B).any(axis=0)
-    if np.any(np.isnan(B)) or np.any(np.isinf(B)):
-        print('WARNING: Mask includes voxels without variance.')
-    # Delete data to free up memory
-    del fmri_normalized  
-    del fmri_flatten
-    
+def fingerprint_simmatrix(A: np.ndarray,
+                          B: np.ndarray) -> np.ndarray:
+    """Similarity matrix between the ROI voxels from their connectivity fingerprints
+    (correlation with the principal components of the data outside the ROI), compared with eta2.
+    Args:
+        A (np.ndarray): (n_roi, T) normalised time series inside the ROI
+        B (np.ndarray): (n_out, T) normalised time series outside the ROI (modified in place)
+    Returns:
+        np.ndarray: (n_roi, n_roi) similarity matrix S
+    """
     # Get voxel-wise connectivity fingerprints 
     print('Computing voxel-wise connectivity fingerprints...')
-    [evecs,Bhat,evals] = pca(B[:,keepB])
+    [evecs,Bhat,evals] = pca(B.T)
     # Compute the correlation matrix of the ROI data with the connectivity fingerprints
-    R = corr(A,Bhat)
+    R = corr(A.T,Bhat)
     print('Computing similarity matrix...')
-    S += eta2(R)
+    S = eta2(R)
     print('Done.')
-    return S, spatial_position
+    return S
 
 
 def simple_simmatrix_in_ROI(fmri_data: np.ndarray,
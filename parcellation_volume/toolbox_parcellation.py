@@ -41,7 +41,9 @@ def extract_3Ddata_from_nii(nii_file):
     return data, original_affine
 
 
-def extract_nii_files(fmri_path, roi_mask_path, brain_mask_path, output_dir):
+def extract_nii_files(fmri_path, roi_mask_path, brain_mask_path, output_dir, load_fmri=True):
+    # With load_fmri=False the fMRI nibabel image is returned instead of its float64 array,
+    # so that the voxels can be read later by slabs (see load_masked_timeseries)
     # Define file paths
     resampled_roi_mask_path = output_dir + 'resampled_roi_mask.nii'
     resampled_brain_mask_path = output_dir + 'resampled_brain_mask.nii'
@@ -89,7 +91,7 @@ def extract_nii_files(fmri_path, roi_mask_path, brain_mask_path, output_dir):
     brain_mask_resampled.to_filename(resampled_brain_mask_path)
 
     # Convert to np array
-    fmri_array = fmri_img.get_fdata()
+    fmri_array = fmri_img.get_fdata() if load_fmri else fmri_img
     roi_mask_array = roi_mask_resampled.get_fdata()
     brain_mask_array = brain_mask_resampled.get_fdata()
 
@@ -97,46 +99,201 @@ def extract_nii_files(fmri_path, roi_mask_path, brain_mask_path, output_dir):
 
 
 
-def pca(X):
-    from scipy.linalg import svd
+def _iter_fmri_slabs(fmri, mask, slab_size=8):
+    """Yield (z0, slab_mask, time series of the slab_mask voxels) for slabs of z-planes starting at z0.
+    The slabs follow the last spatial axis, the contiguous one in the (Fortran ordered) NIfTI file, so each
+    slab is one sequential read. fmri can be a nibabel image (read from img.dataobj, the 4D volume is never
+    fully loaded) or a 4D array."""
+    data = fmri.dataobj if hasattr(fmri, 'dataobj') else fmri
+    for z0 in range(0, mask.shape[2], slab_size):
+        slab_mask = mask[:, :, z0:z0 + slab_size]
+        if not slab_mask.any():
+            continue
+        slab = np.asarray(data[:, :, z0:z0 + slab_size])
+        if slab.flags.f_contiguous and not slab.flags.c_contiguous:
+            # Voxels x time view of the Fortran ordered slab, gather the voxels along its contiguous rows
+            voxels = np.ravel_multi_index(np.nonzero(slab_mask), slab_mask.shape, order='F')
+            yield z0, slab_mask, slab.reshape(-1, slab.shape[-1], order='F').T[:, voxels].T
+        else:
+            yield z0, slab_mask, slab[slab_mask]
+
+
+def load_masked_timeseries(fmri, mask, slab_size=8):
+    """
+    Read and z-score the time series of the voxels inside a mask only, slab by slab.
+    Args:
+        fmri (nib.Nifti1Image | str | np.ndarray): 4D fMRI image, path to it or 4D array.
+        mask (np.ndarray): 3D mask in the fMRI voxel grid (voxels > 0 are read).
+        slab_size (int, optional): number of z-planes read at once. Defaults to 8.
+    Returns:
+        Z (np.ndarray): (n_voxels, T) float32 z-scored time series, in the order of np.where(mask > 0).
+                        Rows of invalid voxels are 0.
+        valid (np.ndarray): (n_voxels,) bool, False for voxels with NaN/inf values or zero variance.
+    """
+    if isinstance(fmri, str):
+        fmri = nib.load(fmri)
+    mask = np.asarray(mask) > 0
+    # Row of each mask voxel in the C order of np.where(mask)
+    row_of = (np.cumsum(mask.ravel()) - 1).reshape(mask.shape)
+    Z = np.zeros((np.count_nonzero(mask), fmri.shape[3]), dtype=np.float32)
+    valid = np.zeros(Z.shape[0], dtype=bool)
+    for z0, slab_mask, ts in _iter_fmri_slabs(fmri, mask, slab_size):
+        rows = row_of[:, :, z0:z0 + slab_size][slab_mask]
+        ts = ts.astype(np.float64)
+        std = np.std(ts, axis=1, keepdims=True)
+        ok = np.isfinite(ts).all(axis=1) & (std[:, 0] > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zs = (ts - np.mean(ts, axis=1, keepdims=True)) / std
+        zs[~ok] = 0
+        Z[rows] = zs
+        valid[rows] = ok
+    return Z, valid
+
+
+def positive_variance_mask(fmri, mask, slab_size=8):
+    """3D bool map of the mask voxels with finite, positive-variance time series (streamed by slabs)"""
+    if isinstance(fmri, str):
+        fmri = nib.load(fmri)
+    mask = np.asarray(mask) > 0
+    out = np.zeros(mask.shape, dtype=bool)
+    for z0, slab_mask, ts in _iter_fmri_slabs(fmri, mask, slab_size):
+        ts = ts.astype(np.float64)
+        out[:, :, z0:z0 + slab_size][slab_mask] = np.isfinite(ts).all(axis=1) & (np.var(ts, axis=1) > 0)
+    return out
+
+
+
+def pca(X, n_components=None, method='gram', block_size=16384):
+    """PCA of a (n_samples, n_features) matrix, X is centered in place.
+    With method='gram' the decomposition is obtained from the eigendecomposition of the small
+    Gram matrix (X X' if n_samples <= n_features, else X' X), accumulated in float64 over
+    column blocks, instead of the full SVD of the wide matrix (T x all brain voxels).
+    Signs are fixed so that the largest absolute entry of each column of U is positive.
+    Components whose singular value is at the rounding level of X are dropped, so fewer than
+    n_components can be returned (at most T-1 for T centered samples).
+    Args:
+        X (np.ndarray): (n_samples, n_features) data, e.g. time x voxels.
+        n_components (int, optional): maximum number of components kept. Defaults to None (all).
+        method (str, optional): 'gram' or 'svd' (full scipy.linalg.svd). Defaults to 'gram'.
+        block_size (int, optional): columns per block for the Gram accumulation. Defaults to 16384.
+    Returns:
+        V (np.ndarray): (n_components, n_features) principal axes.
+        Y (np.ndarray): (n_samples, n_components) projection of X onto the axes (U*sigma).
+        evals (np.ndarray): (n_components,) eigenvalues of X'X/(n-1).
+    """
+    from scipy.linalg import svd, eigh
     # Center X by subtracting off column means
     X -= np.mean(X,0)
-    # The principal components are the eigenvectors of S = X'*X./(n-1), but computed using SVD
-    [U,sigma,V] = svd(X,full_matrices=False)
+    n_samples, n_features = X.shape
+    k = min(X.shape) if n_components is None else min(n_components, min(X.shape))
+    if method == 'svd':
+        # The principal components are the eigenvectors of S = X'*X./(n-1), but computed using SVD
+        [U,sigma,V] = svd(X,full_matrices=False)
+        U, sigma, V = U[:, :k], sigma[:k], V[:k]
+    elif method == 'gram':
+        if n_samples <= n_features:
+            G = np.zeros((n_samples, n_samples))
+            for start in range(0, n_features, block_size):
+                Xb = X[:, start:start + block_size].astype(np.float64)
+                G += Xb @ Xb.T
+        else:
+            X64 = X.astype(np.float64)
+            G = X64.T @ X64
+        # Largest k eigenpairs, in decreasing order
+        evals, evecs = eigh(G, subset_by_index=[G.shape[0] - k, G.shape[0] - 1])
+        evals, evecs = evals[::-1], evecs[:, ::-1]
+        sigma = np.sqrt(np.maximum(evals, 0))
+        # Directions with (numerically) zero singular value are left at 0
+        valid = sigma > sigma.max(initial=0) * max(X.shape) * np.finfo(np.float64).eps
+        inv_sigma = np.divide(1, sigma, out=np.zeros_like(sigma), where=valid)
+        if n_samples <= n_features:
+            U = evecs
+            V = np.empty((k, n_features), dtype=X.dtype)
+            for start in range(0, n_features, block_size):
+                Xb = X[:, start:start + block_size].astype(np.float64)
+                V[:, start:start + block_size] = (U.T @ Xb) * inv_sigma[:, None]
+        else:
+            V = evecs.T.astype(X.dtype)
+            U = (X.astype(np.float64) @ evecs) * inv_sigma
+        sigma = sigma.astype(X.dtype)
+    else:
+        raise ValueError(f"Unknown PCA method: {method}")
+    # Directions with a singular value at the rounding level of X (e.g. the null direction of
+    # centered z-scored data) carry no signal: they would give zero (nan correlations) or noise columns in Y
+    eps = np.finfo(X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64).eps
+    keep = sigma > sigma.max(initial=0) * max(X.shape) * eps
+    U, sigma, V = U[:, keep], sigma[keep], V[keep]
+    # Deterministic signs
+    signs = np.sign(U[np.argmax(np.abs(U), axis=0), np.arange(U.shape[1])])
+    signs[signs == 0] = 1
+    U = U * signs
+    V = V * signs[:, None].astype(V.dtype)
     # Project X onto the principal component axes
-    Y = U*sigma
+    Y = (U*sigma).astype(X.dtype)
     # Convert the singular values to eigenvalues 
-    sigma /= np.sqrt(X.shape[0]-1)
+    sigma = sigma / np.sqrt(X.shape[0]-1)
     evals = np.square(sigma)
     
     return V, Y, evals
 
 def corr(X,Y):
-    Y = Y.T
-    X = X.T
-    R = np.zeros((X.shape[0],Y.shape[0]))
-    for i in range(0,R.shape[1]):
-        y = Y[i,:]
-        Xm = np.reshape(np.mean(X,axis=1),(X.shape[0],1))
-        ym = np.mean(y)
-        r_num = np.sum((X-Xm)*(y-ym),axis=1)
-        r_den = np.sqrt(np.sum((X-Xm)**2,axis=1)*np.sum((y-ym)**2))
-        R[:,i] = r_num / r_den
+    """Pearson correlation between the columns of X (T, n) and of Y (T, m).
+    Both are z-scored once and R is a single matrix product, columns without variance give nan.
+    Returns:
+        np.ndarray: (n, m) correlation matrix R.
+    """
+    def zscore(Z):
+        Z = np.asarray(Z, dtype=np.float64)
+        Z = Z - Z.mean(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return Z / np.sqrt(np.square(Z).sum(axis=0))
+    R = zscore(X).T @ zscore(Y)
     return R
 
-def eta2(X):
+def eta2(X, block_size=None, max_memory_gb=0.5, n_jobs=1):
+    """Eta squared similarity between all pairs of rows of X (Cohen et al. 2008).
+    For rows a, b of length k with sums s and sums of squares q:
+        ssw = (q_a + q_b - 2 a.b) / 2
+        sst = q_a + q_b - (s_a + s_b)^2 / (2k)
+        eta2 = 1 - ssw / sst
+    so every block of the (n, n) matrix is one matrix product. The upper triangle is computed
+    block by block (mirrored to the lower one), optionally spread over threads.
+    Args:
+        X (np.ndarray): (n, k) fingerprints, one per row.
+        block_size (int, optional): rows per block. Defaults to the largest block fitting max_memory_gb.
+        max_memory_gb (float, optional): memory cap for the block temporaries (all threads). Defaults to 0.5.
+        n_jobs (int, optional): number of threads. Defaults to 1.
+    Returns:
+        np.ndarray: (n, n) similarity matrix S.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    X = np.asarray(X, dtype=np.float64)
+    n, k = X.shape
+    row_sums = X.sum(axis=1)
+    row_sq_sums = np.square(X).sum(axis=1)
+    if block_size is None:
+        # ~4 float64 (b, b) temporaries per thread
+        block_size = int(np.sqrt(max_memory_gb * 1024**3 / (4 * 8 * n_jobs)))
+    block_size = max(1, min(block_size, n))
     
-    S = np.zeros((X.shape[0],X.shape[0]))
-    for i in range(0,X.shape[0]):
-        for j in range(i,X.shape[0]):
-            mi = np.mean([X[i,:],X[j,:]],0) 
-            mm = np.mean(mi)
-            ssw = np.sum(np.square(X[i,:]-mi) + np.square(X[j,:]-mi))
-            sst = np.sum(np.square(X[i,:]-mm) + np.square(X[j,:]-mm))
-            S[i,j] = 1-ssw/sst
+    S = np.zeros((n, n))
+    def fill_block(bounds):
+        i0, i1, j0, j1 = bounds
+        q = row_sq_sums[i0:i1, None] + row_sq_sums[None, j0:j1]
+        ssw = np.maximum(q - 2 * (X[i0:i1] @ X[j0:j1].T), 0) / 2
+        sst = q - np.square(row_sums[i0:i1, None] + row_sums[None, j0:j1]) / (2 * k)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block = 1 - ssw / sst
+            if i0 == j0: # exact diagonal (ssw = 0)
+                np.fill_diagonal(block, 1 - 0 / np.diag(sst))
+        S[i0:i1, j0:j1] = block
+        S[j0:j1, i0:i1] = block.T
     
-    S += S.T 
-    S -= np.eye(S.shape[0])
+    starts = range(0, n, block_size)
+    blocks = [(i0, min(i0 + block_size, n), j0, min(j0 + block_size, n))
+              for i0 in starts for j0 in starts if j0 >= i0]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        list(pool.map(fill_block, blocks))
     
     return S
 
@@ -146,41 +303,51 @@ def eta2(X):
 
 def create_boundary_maps(parcellation):
     """This function creates the boundary maps from a parcellation data.
+    A voxel is a boundary if one of its six neighbors has another value (shifted-array comparisons).
+    The outer shell of the volume is never a boundary.
     Args:
         parcellation (3D np.array): 3D numpy array representing the parcellation data
         The values are integers representing the different parcels.
+        A (n_maps, x, y, z) stack of parcellations gives a stack of boundary maps.
     Returns:
         3D np.array: 3D numpy array representing the boundary map.
     """ 
+    parcellation = np.asarray(parcellation)
     #Initialize the boundary map with zeros
-    boundary_map = np.zeros_like(parcellation, dtype=int)
-    
-    # Get the shape of the parcellation
-    x_dim, y_dim, z_dim = parcellation.shape
-    
-    # Iterate through each voxel in the 3D array (excluding the edges to avoid out-of-bounds access)
-    for x in range(1, x_dim - 1):
-        for y in range(1, y_dim - 1):
-            for z in range(1, z_dim - 1):
-                # Current voxel value
-                current_value = parcellation[x, y, z]
-                
-                # Check the six neighbors (left, right, front, back, above, below)
-                neighbors = [
-                    parcellation[x - 1, y, z],  # left
-                    parcellation[x + 1, y, z],  # right
-                    parcellation[x, y - 1, z],  # front
-                    parcellation[x, y + 1, z],  # back
-                    parcellation[x, y, z - 1],  # below
-                    parcellation[x, y, z + 1]   # above
-                ]
-                
-                # If the current voxel value differs from any of its neighbors, it's a boundary
-                if any(current_value != neighbor for neighbor in neighbors):
-                    boundary_map[x, y, z] = 1
+    boundary_map = np.zeros(parcellation.shape, dtype=int)
+    # Spatial axes are the last three, the outer shell is left at zero
+    spatial_axes = range(parcellation.ndim - 3, parcellation.ndim)
+    inner = (Ellipsis,) + (slice(1, -1),) * 3
+    current_value = parcellation[inner]
+    is_boundary = np.zeros(current_value.shape, dtype=bool)
+    # Compare with the six neighbors (left, right, front, back, below, above)
+    for axis in spatial_axes:
+        for shift in (-1, 1):
+            neighbor = [slice(None)] * parcellation.ndim
+            for a in spatial_axes:
+                neighbor[a] = slice(1, -1)
+            neighbor[axis] = slice(1 + shift, parcellation.shape[axis] - 1 + shift)
+            is_boundary |= current_value != parcellation[tuple(neighbor)]
+    boundary_map[inner] = is_boundary
     return boundary_map
 
 
+def boundary_probability(parcellations, batch_size=8):
+    """Fraction of the parcellations (e.g. subjects) in which each voxel is a boundary (see create_boundary_maps).
+    Args:
+        parcellations (np.ndarray or list): (n_maps, x, y, z) stack of parcellations.
+        batch_size (int, optional): number of parcellations compared at once. Defaults to 8.
+    Returns:
+        np.ndarray: 3D boundary probability map.
+    """
+    n_maps = len(parcellations)
+    boundary_count = np.zeros(np.shape(parcellations[0]), dtype=np.int32)
+    for start in range(0, n_maps, batch_size):
+        batch = np.stack([np.asarray(p) for p in parcellations[start:start + batch_size]])
+        boundary_count += create_boundary_maps(batch).sum(axis=0, dtype=np.int32)
+    return boundary_count / n_maps
+
+
 # This part is used to download data from the HCP
 def expand_mask(mask, expansion_voxels=2):
     """
@@ -66,77 +66,41 @@ def find_seeds(gradient_magnitude_map: np.ndarray,
     Returns:
         np.ndarray: Seeds for the watershed algorithm
     """
-    from scipy.spatial.distance import cdist
-    # Identify voxels within the ROI
-    spatial_position = np.array(np.where(roi > 0)).T
-    n_voxels = len(spatial_position)
+    from scipy.ndimage import minimum_filter
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix, csgraph
+    roi = roi > 0
 
     # Initialize the seeds map (0 for no seed, 1 for seed)
     seeds_map = np.zeros(gradient_magnitude_map.shape, dtype=np.int32)
 
-    # Identify local minima within the ROI
-    local_minima_coords = []
-    for idx in range(n_voxels):
-        x, y, z = spatial_position[idx]
-        is_minimum = True
-
-        # Generate all neighbors in the 3x3x3 cube excluding the center voxel itself
-        for dx in [-1, 0, 1]:
-            xi = x + dx
-            if xi < 0 or xi >= gradient_magnitude_map.shape[0]:
-                continue
-            for dy in [-1, 0, 1]:
-                yi = y + dy
-                if yi < 0 or yi >= gradient_magnitude_map.shape[1]:
-                    continue
-                for dz in [-1, 0, 1]:
-                    zi = z + dz
-                    if zi < 0 or zi >= gradient_magnitude_map.shape[2]:
-                        continue
-                    if (dx == 0 and dy == 0 and dz == 0):
-                        continue
-                    if roi[xi, yi, zi] > 0:
-                        if gradient_magnitude_map[xi, yi, zi] < gradient_magnitude_map[x, y, z]:
-                            is_minimum = False
-                            break
-                if not is_minimum:
-                    break
-            if not is_minimum:
-                break
-
-        if is_minimum:
-            local_minima_coords.append((x, y, z))
-
-    # Convert list to numpy array for efficient computation
-    local_minima_coords = np.array(local_minima_coords)
+    # Identify local minima within the ROI: no neighbor of the 3x3x3 cube inside the ROI
+    # has a smaller value (voxels outside the ROI or the volume count as +inf)
+    values = np.where(roi, gradient_magnitude_map, np.inf)
+    neighborhood_min = minimum_filter(values, size=3, mode='constant', cval=np.inf)
+    local_minima_coords = np.argwhere(roi & (neighborhood_min >= gradient_magnitude_map))
 
     if len(local_minima_coords) == 0:
         return seeds_map  # No seeds found
 
-    # Compute pairwise distances between minima
-    distances = cdist(local_minima_coords, local_minima_coords)
-
     # Use a clustering approach to merge seeds that are too close
-    # Create a connectivity graph where edges exist between seeds closer than min_distance
-    adjacency_matrix = distances < min_distance
-    np.fill_diagonal(adjacency_matrix, 0)  # Remove self-connections
+    # Create a sparse connectivity graph where edges exist between seeds closer than min_distance
+    pairs = cKDTree(local_minima_coords).query_pairs(r=min_distance, output_type='ndarray')
+    distances = np.linalg.norm(local_minima_coords[pairs[:, 0]] - local_minima_coords[pairs[:, 1]], axis=1)
+    pairs = pairs[distances < min_distance]
 
-    # Label connected components in the adjacency matrix
-    # First, we need to create an undirected graph from the adjacency matrix
-    from scipy.sparse import csgraph
+    # Label connected components of the seed graph
     n_seeds = local_minima_coords.shape[0]
-    graph = csgraph.csgraph_from_dense(adjacency_matrix, null_value=0)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n_seeds, n_seeds))
     n_components, labels = csgraph.connected_components(csgraph=graph, directed=False)
 
-    # For each cluster of seeds, compute the center of mass and place a single seed there
-    for cluster_label in range(n_components):
-        cluster_indices = np.where(labels == cluster_label)[0]
-        cluster_coords = local_minima_coords[cluster_indices]
-        # Compute the center of mass (mean position)
-        com = np.mean(cluster_coords, axis=0).astype(int)
-        # Ensure the center of mass is within the image bounds
-        com = np.clip(com, [0, 0, 0], np.array(gradient_magnitude_map.shape) - 1)
-        seeds_map[tuple(com)] = 1  # Assign a unique label to each seed
+    # For each cluster of seeds, compute the center of mass (mean position) and place a single seed there
+    counts = np.bincount(labels, minlength=n_components)
+    com = np.stack([np.bincount(labels, weights=local_minima_coords[:, axis], minlength=n_components) / counts
+                    for axis in range(3)], axis=1).astype(int)
+    # Ensure the center of mass is within the image bounds
+    com = np.clip(com, [0, 0, 0], np.array(gradient_magnitude_map.shape) - 1)
+    seeds_map[tuple(com.T)] = 1
 
     return seeds_map
 
@@ -145,18 +109,127 @@ def find_seeds(gradient_magnitude_map: np.ndarray,
 
 # TODO : Implement the watershed algorithm BIG TODO (for now it doesn't work)
 
+def _neighbor_offsets(shape, connectivity=6):
+    """Flat-index offsets of the 6, 18 or 26 neighbors in a C-ordered array of given 3D shape
+    (6-connectivity order: -x, +x, -y, +y, -z, +z)"""
+    if connectivity not in (6, 18, 26):
+        raise ValueError(f"connectivity must be 6, 18 or 26, got {connectivity}")
+    strides = np.array([shape[1] * shape[2], shape[2], 1])
+    offsets = [sign * stride for stride in strides for sign in (-1, 1)]
+    for d in np.ndindex(3, 3, 3):
+        d = np.array(d) - 1
+        n_nonzero = np.count_nonzero(d)
+        if n_nonzero == 2 and connectivity >= 18 or n_nonzero == 3 and connectivity == 26:
+            offsets.append(int(d @ strides))
+    return offsets
+
+
+def _flood(priority, process_mask, labels, offsets, n_levels=None, mark_boundaries=False):
+    """
+    Flooding engine on flat indices of a padded volume (the padding is never processed, so no bounds checks).
+    Voxels are popped by increasing priority, ties by increasing flat index, and take the label of the voxel
+    that queued them.
+    Args:
+        priority (np.ndarray): (n,) flat priorities.
+        process_mask (np.ndarray): (n,) bool, voxels that can be flooded.
+        labels (np.ndarray): (n,) int32 seed labels (> 0), modified in place.
+        offsets (list): flat neighbor offsets.
+        n_levels (int, optional): use a bucket queue over n_levels quantized priority levels (FIFO inside a level)
+            instead of the exact heap. Defaults to None (heap).
+        mark_boundaries (bool, optional): label -1 (and do not grow) the voxels reaching a different label. Defaults to False.
+    """
+    from array import array
+    from collections import deque
+    # Typed arrays, with fast scalar access in the loop
+    status = bytearray(len(labels))  # 0: unprocessed, 1: in queue, 2: processed
+    can_process = bytearray(process_mask.astype(np.uint8).tobytes())
+    label_of = array('i', labels.astype(np.int32).tobytes())
+    seeds = np.flatnonzero(labels > 0)
+    status_view = np.frombuffer(status, dtype=np.uint8)
+    status_view[seeds] = 2  # Mark seed points as processed
+    
+    if n_levels is None:
+        # Rank of every voxel in the (priority, flat index) order: the heap only holds ints
+        order = np.lexsort((np.arange(len(priority)), priority))
+        rank = np.empty(len(priority), dtype=np.int64)
+        rank[order] = np.arange(len(priority))
+        keys, order = rank.tolist(), order.tolist()
+        heap = []
+        def push(voxel):
+            heapq.heappush(heap, keys[voxel])
+        def pop():
+            return order[heapq.heappop(heap)]
+    else:
+        finite = process_mask & np.isfinite(priority)
+        low, high = (priority[finite].min(), priority[finite].max()) if finite.any() else (0, 0)
+        scale = (n_levels - 1) / (high - low) if high > low else 0
+        keys = np.clip(np.nan_to_num((priority - low) * scale, posinf=n_levels - 1), 0, n_levels - 1).astype(np.int64).tolist()
+        buckets = [deque() for _ in range(n_levels)]
+        current = [0]
+        def push(voxel):
+            # a voxel below the current level waits in the current one
+            buckets[max(keys[voxel], current[0])].append(voxel)
+        def pop():
+            while not buckets[current[0]]:
+                current[0] += 1
+            return buckets[current[0]].popleft()
+    
+    # The seed neighbors start the flooding
+    n_queued = 0
+    for voxel in seeds.tolist():
+        for offset in offsets:
+            neighbor = voxel + offset
+            if can_process[neighbor] and status[neighbor] == 0:
+                label_of[neighbor] = label_of[voxel]
+                status[neighbor] = 1  # Mark as in queue
+                push(neighbor)
+                n_queued += 1
+    
+    # Process the queue
+    while n_queued:
+        voxel = pop()
+        n_queued -= 1
+        current_label = label_of[voxel]
+        status[voxel] = 2  # Mark as processed
+        if mark_boundaries:
+            reached = {label_of[voxel + offset] for offset in offsets if status[voxel + offset] == 2}
+            if any(label > 0 and label != current_label for label in reached):
+                label_of[voxel] = -1
+                continue
+        # Add neighbors to queue
+        for offset in offsets:
+            neighbor = voxel + offset
+            if can_process[neighbor] and status[neighbor] == 0:
+                label_of[neighbor] = current_label
+                status[neighbor] = 1
+                push(neighbor)
+                n_queued += 1
+    
+    # Voxels still queued (never popped) keep no label
+    labels[:] = np.frombuffer(label_of, dtype=np.int32) * (status_view == 2)
+    return labels
+
+
 def watershed_by_flooding(gradient_magnitude_map: np.ndarray,
                         seeds: np.ndarray,
                         mask: np.ndarray,
-                        flooding_percent: float=85) -> np.ndarray:
+                        flooding_percent: float=85,
+                        connectivity: int=6,
+                        n_levels: int=None,
+                        mark_boundaries: bool=False) -> np.ndarray:
     """
     Performs watershed segmentation by flooding, but restricts the flooding to the lowest 80% of gradient magnitude values.
+    The flooding runs on flat indices of a padded volume, with precomputed neighbor offsets.
 
     Args:
         gradient_magnitude_map (np.ndarray): The gradient magnitude map of the volume.
         seeds (np.ndarray): Seed points for the watershed algorithm.
         mask (np.ndarray): A mask to restrict the segmentation to a region of interest.
         flooding_percent (float): The percentage of lowest gradient magnitudes to flood.
+        connectivity (int): 6, 18 or 26 neighbors. Defaults to 6.
+        n_levels (int): if given, use a bucket queue over n_levels quantized gradient levels
+                        instead of the exact priority queue. Defaults to None.
+        mark_boundaries (bool): label -1 the voxels where two regions meet. Defaults to False.
     Returns:
         np.ndarray: The labeled volume after watershed segmentation.
     """
@@ -175,54 +248,16 @@ def watershed_by_flooding(gradient_magnitude_map: np.ndarray,
     # Initialize labels array
     labels, _ = ndimage.label(seeds > 0)
     
-    # Initialize priority queue
-    # Elements are tuples: (priority, x, y, z, label)
-    heap = []
-    
-    # Create a status array to keep track of voxels
-    # status == 0: unprocessed, status == 1: in queue, status == 2: processed
-    status = np.zeros(labels.shape, dtype=np.uint8)
-    status[labels > 0] = 2  # Mark seed points as processed
-
-    # Get coordinates of all labeled seed points
-    labeled_coords = np.argwhere(labels > 0)
-    
-    # For each labeled voxel, add its unprocessed neighbors to the queue
-    for x, y, z in labeled_coords:
-        current_label = labels[x, y, z]
-        # Check 6-connected neighbors
-        for dx, dy, dz in [(-1,0,0), (1,0,0), (0,-1,0), (0,1,0), (0,0,-1), (0,0,1)]:
-            nx, ny, nz = x + dx, y + dy, z + dz
-            if (0 <= nx < labels.shape[0] and
-                0 <= ny < labels.shape[1] and
-                0 <= nz < labels.shape[2]):
-                if process_mask[nx, ny, nz] and status[nx, ny, nz] == 0:
-                    priority = gradient_magnitude_map[nx, ny, nz]
-                    heapq.heappush(heap, (priority, nx, ny, nz, current_label))
-                    status[nx, ny, nz] = 1  # Mark as in queue
-
-    # Process the priority queue
-    while heap:
-        priority, x, y, z, current_label = heapq.heappop(heap)
-        if status[x, y, z] == 2:
-            continue  # Already processed
-        if labels[x, y, z] == 0:
-            labels[x, y, z] = current_label
-        elif labels[x, y, z] != current_label:
-            # Conflict detected, mark as boundary (-1)
-            labels[x, y, z] = -1
-        status[x, y, z] = 2  # Mark as processed
-        
-        # Add neighbors to queue
-        for dx, dy, dz in [(-1,0,0), (1,0,0), (0,-1,0), (0,1,0), (0,0,-1), (0,0,1)]:
-            nx, ny, nz = x + dx, y + dy, z + dz
-            if (0 <= nx < labels.shape[0] and
-                0 <= ny < labels.shape[1] and
-                0 <= nz < labels.shape[2]):
-                if process_mask[nx, ny, nz] and status[nx, ny, nz] == 0:
-                    neighbor_priority = gradient_magnitude_map[nx, ny, nz]
-                    heapq.heappush(heap, (neighbor_priority, nx, ny, nz, labels[x, y, z]))
-                    status[nx, ny, nz] = 1  # Mark as in queue
+    # Pad by one unprocessed voxel so that neighbors never leave the array
+    padded_shape = tuple(np.array(labels.shape) + 2)
+    flat_labels = np.pad(labels, 1).astype(np.int32).ravel()
+    _flood(np.pad(gradient_magnitude_map, 1, constant_values=np.inf).ravel(),
+           np.pad(process_mask, 1).ravel(),
+           flat_labels,
+           _neighbor_offsets(padded_shape, connectivity),
+           n_levels=n_levels,
+           mark_boundaries=mark_boundaries)
+    labels = flat_labels.reshape(padded_shape)[1:-1, 1:-1, 1:-1]
     
     # Apply the mask to remove labels outside the region of interest
     labels = labels * mask
@@ -269,7 +304,7 @@ if __name__ == "__main__":
     # Save the parcellation map
     outdir_parcel = 'G:/DATA_min_preproc/dataset_study1/S02/outputs/parcels'
     # Save the parcellation map
-    out_base_name = f'parcellation_map_{datetime.now().strftime('%Y%m%d_%H%M%S')}'
+    out_base_name = f'parcellation_map_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
     # Ensure the output directory exists
     os.makedirs(outdir_parcel, exist_ok=True)
     nii_img = nib.Nifti1Image(labels_map, affine=original_affine)